@@ -4,6 +4,8 @@ Soporta múltiples tipos de negocio: salon, clinic, store, restaurant
 """
 
 from google.genai import types
+from collections.abc import Mapping
+from typing import Any
 from datetime import datetime, timedelta
 import logging
 import pytz
@@ -310,6 +312,34 @@ TOOL_DEFINITIONS = [
 class ToolExecutor:
     """Ejecuta las herramientas según el tipo de negocio."""
     
+    # Herramientas que solo consultan (no crean/modifican citas ni datos):
+    # se pueden ejecutar en paralelo cuando Gemini pide varias en el mismo turno
+    READ_ONLY = frozenset({
+        "ver_servicios",
+        "ver_profesionales",
+        "buscar_disponibilidad",
+        "ver_mis_citas",
+    })
+    
+    # Nombre de la herramienta -> método que la atiende (se arma una sola vez)
+    _HANDLERS = {
+        "ver_servicios": "_ver_servicios",
+        "ver_profesionales": "_ver_profesionales",
+        "buscar_disponibilidad": "_buscar_disponibilidad",
+        "crear_cita": "_crear_cita",
+        "ver_mis_citas": "_ver_mis_citas",
+        "confirmar_cita": "_confirmar_cita",
+        "cancelar_cita": "_cancelar_cita",
+        "modificar_cita": "_modificar_cita",
+        "guardar_datos_usuario": "_guardar_datos",
+        "escalar_a_humano": "_escalar_a_humano",
+    }
+    
+    __slots__ = (
+        "client", "customer", "config", "business_type", "calendar_id",
+        "escalated", "escalation_data",
+    )
+    
     def __init__(self, client: Client, customer: Customer):
         self.client = client
         self.customer = customer
@@ -333,32 +363,19 @@ class ToolExecutor:
                         or pid in p.get("id", "").lower()), None)
         return prof
     
-    async def execute(self, function_name: str, args: dict) -> str:
-        """Ejecuta una función por nombre."""
+    async def execute(self, function_name: str, args: Mapping[str, Any]) -> str:
+        """Ejecuta una función por nombre. Los handlers solo leen args (no se copian)."""
         logger.info(f"Ejecutando: {function_name} | Tipo: {self.business_type}")
         
-        handlers = {
-            "ver_servicios": self._ver_servicios,
-            "ver_profesionales": self._ver_profesionales,
-            "buscar_disponibilidad": self._buscar_disponibilidad,
-            "crear_cita": self._crear_cita,
-            "ver_mis_citas": self._ver_mis_citas,
-            "confirmar_cita": self._confirmar_cita,
-            "cancelar_cita": self._cancelar_cita,
-            "modificar_cita": self._modificar_cita,
-            "guardar_datos_usuario": self._guardar_datos,
-            "escalar_a_humano": self._escalar_a_humano,
-        }
-        
-        handler = handlers.get(function_name)
-        if handler:
-            return await handler(args)
+        method_name = self._HANDLERS.get(function_name)
+        if method_name:
+            return await getattr(self, method_name)(args)
         return f"Herramienta '{function_name}' no reconocida"
     
     # ==========================================
     # VER SERVICIOS / CATÁLOGO
     # ==========================================
-    async def _ver_servicios(self, args: dict) -> str:
+    async def _ver_servicios(self, args: Mapping[str, Any]) -> str:
         """Muestra servicios/productos según tipo de negocio."""
         categoria = args.get("categoria", "").strip().lower()
         pregunta = (args.get("pregunta") or "").strip()
@@ -460,7 +477,7 @@ class ToolExecutor:
     # ==========================================
     # VER PROFESIONALES (CLÍNICAS)
     # ==========================================
-    async def _ver_profesionales(self, args: dict) -> str:
+    async def _ver_profesionales(self, args: Mapping[str, Any]) -> str:
         """Muestra profesionales disponibles (clínicas)."""
         especialidad = args.get("especialidad", "").lower()
         professionals = self.config.get("professionals", [])
@@ -497,7 +514,7 @@ class ToolExecutor:
     # ==========================================
     # BUSCAR DISPONIBILIDAD
     # ==========================================
-    async def _buscar_disponibilidad(self, args: dict) -> str:
+    async def _buscar_disponibilidad(self, args: Mapping[str, Any]) -> str:
         """Busca horarios disponibles."""
         try:
             fecha_str = args.get("fecha")
@@ -607,7 +624,7 @@ class ToolExecutor:
     # ==========================================
     # CREAR CITA / RESERVACIÓN / ENTREGA
     # ==========================================
-    async def _crear_cita(self, args: dict) -> str:
+    async def _crear_cita(self, args: Mapping[str, Any]) -> str:
         """Crea una cita según tipo de negocio.
         
         Para CLÍNICAS: profesional_id es OBLIGATORIO si hay múltiples profesionales
@@ -878,7 +895,7 @@ class ToolExecutor:
     # ==========================================
     # VER MIS CITAS
     # ==========================================
-    async def _ver_mis_citas(self, args: dict) -> str:
+    async def _ver_mis_citas(self, args: Mapping[str, Any]) -> str:
         """Lista citas del usuario."""
         try:
             from app.models.tables import Appointment
@@ -926,7 +943,7 @@ class ToolExecutor:
     # ==========================================
     # CONFIRMAR CITA
     # ==========================================
-    async def _confirmar_cita(self, args: dict) -> str:
+    async def _confirmar_cita(self, args: Mapping[str, Any]) -> str:
         """Confirma la asistencia a la cita más próxima del usuario."""
         try:
             from app.models.tables import Appointment
@@ -967,7 +984,7 @@ class ToolExecutor:
     # ==========================================
     # CANCELAR CITA
     # ==========================================
-    async def _cancelar_cita(self, args: dict) -> str:
+    async def _cancelar_cita(self, args: Mapping[str, Any]) -> str:
         """Cancela una cita, buscando por ID o por fecha/profesional."""
         try:
             from app.services.calendar import calendar_service
@@ -1134,7 +1151,7 @@ class ToolExecutor:
     # ==========================================
     # MODIFICAR/REAGENDAR CITA
     # ==========================================
-    async def _modificar_cita(self, args: dict) -> str:
+    async def _modificar_cita(self, args: Mapping[str, Any]) -> str:
         """Modifica una cita existente a nueva fecha/hora."""
         try:
             from app.services.calendar import calendar_service
@@ -1305,8 +1322,7 @@ class ToolExecutor:
                     # 2) Crear nuevo evento en la nueva fecha/hora
                     title = f"Cita: {self.customer.full_name or 'Cliente'}"
                     if appointment.notes:
-                        notes_parts = appointment.notes.split('\n')
-                        title = notes_parts[0] if notes_parts else title
+                        title = appointment.notes.partition('\n')[0]
                     new_event = await calendar_service.create_appointment(
                         calendar_id=calendar_id,
                         title=title,
@@ -1344,8 +1360,7 @@ class ToolExecutor:
                         try:
                             from app.services.email_service import email_service
                             
-                            notes_parts = appointment.notes.split('\n') if appointment.notes else []
-                            servicio = notes_parts[0] if notes_parts else "Cita"
+                            servicio = appointment.notes.partition('\n')[0] if appointment.notes else "Cita"
                             appointment_details = {
                                 "servicio": servicio,
                                 "profesional": profesional_nombre,
@@ -1386,7 +1401,7 @@ class ToolExecutor:
     # ==========================================
     # GUARDAR DATOS
     # ==========================================
-    async def _guardar_datos(self, args: dict) -> str:
+    async def _guardar_datos(self, args: Mapping[str, Any]) -> str:
         """Guarda datos del usuario."""
         try:
             from app.services.client_service import client_service
@@ -1406,7 +1421,7 @@ class ToolExecutor:
     # ==========================================
     # ESCALAR A HUMANO
     # ==========================================
-    async def _escalar_a_humano(self, args: dict) -> str:
+    async def _escalar_a_humano(self, args: Mapping[str, Any]) -> str:
         """Escala a agente humano y marca la conversación para que la IA no intervenga."""
         try:
             from app.services.client_service import client_service
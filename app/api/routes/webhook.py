@@ -278,26 +278,15 @@ async def handle_message(msg: ProcessedMessage):
         
         logger.debug(f"Customer: {customer.full_name or customer.phone_number}")
         
-        # 3. Marcar como leído inmediatamente (✓✓ azules)
-        await whatsapp_service.mark_as_read(
+        # 3-4. Marcar como leído (✓✓ azules) + indicador de "escribiendo..." en una sola llamada
+        await whatsapp_service.acknowledge(
             msg.message_id,
+            typing=True,
             access_token=wa_token,
             phone_number_id=wa_phone_id,
             api_version=wa_version,
         )
         
-        # 4. Indicador de "escribiendo..." nativo de WhatsApp
-        try:
-            await whatsapp_service.send_typing_indicator(
-                to=msg.phone_number,
-                message_id=msg.message_id,
-                access_token=wa_token,
-                phone_number_id=wa_phone_id,
-                api_version=wa_version,
-            )
-        except Exception:
-            pass  # No es crítico
-        
         # 5. Procesar contenido según tipo
         user_message = msg.content
         
@@ -331,6 +320,7 @@ async def handle_message(msg: ProcessedMessage):
                 business_context,
                 access_token=wa_token,
                 api_version=wa_version,
+                client_id=client.id,
             )
             
             # Construir mensaje con contexto claro para el chat principal
@@ -372,22 +362,31 @@ async def handle_message(msg: ProcessedMessage):
         # 7. Generar respuesta con Gemini
         logger.debug("Generando respuesta con Gemini...")
         
-        response_text = await gemini_service.chat(
-            message=user_message,
-            history=history,
-            client=client,
-            customer=customer
-        )
-        
-        # 8. Enviar respuesta
-        await whatsapp_service.send_text_message(
-            to=msg.phone_number,
-            message=response_text,
-            access_token=wa_token,
-            phone_number_id=wa_phone_id,
-            api_version=wa_version,
-            client_id=client.id,
-        )
+        if settings.WHATSAPP_STREAM_REPLIES:
+            # 7-8. Generar y enviar por párrafos a medida que llegan
+            response_text = await send_streamed_reply(
+                msg, user_message, history, client, customer,
+                access_token=wa_token,
+                phone_number_id=wa_phone_id,
+                api_version=wa_version,
+            )
+        else:
+            response_text = await gemini_service.chat(
+                message=user_message,
+                history=history,
+                client=client,
+                customer=customer
+            )
+            
+            # 8. Enviar respuesta
+            await whatsapp_service.send_text_message(
+                to=msg.phone_number,
+                message=response_text,
+                access_token=wa_token,
+                phone_number_id=wa_phone_id,
+                api_version=wa_version,
+                client_id=client.id,
+            )
         
         # 9. Guardar respuesta en memoria
         await memory.add_message("assistant", response_text)
@@ -410,3 +409,51 @@ async def handle_message(msg: ProcessedMessage):
                 )
         except Exception as send_err:
             logger.warning(f"No se pudo enviar mensaje de error al usuario: {send_err}")
+
+
+async def send_streamed_reply(
+    msg: ProcessedMessage,
+    user_message: str,
+    history: list[dict],
+    client,
+    customer,
+    *,
+    access_token: str,
+    phone_number_id: str,
+    api_version: str,
+) -> str:
+    """
+    Genera la respuesta en streaming y envía cada párrafo completo como un mensaje
+    de WhatsApp en cuanto está listo (el cliente ve el primero sin esperar al resto).
+    
+    Returns:
+        Texto completo enviado (para guardarlo en memoria)
+    """
+    sent = []
+    
+    async def send(text: str):
+        await whatsapp_service.send_text_message(
+            to=msg.phone_number,
+            message=text,
+            access_token=access_token,
+            phone_number_id=phone_number_id,
+            api_version=api_version,
+            client_id=client.id,
+        )
+        sent.append(text)
+    
+    pending = ""
+    async for chunk in gemini_service.chat_stream(
+        message=user_message,
+        history=history,
+        client=client,
+        customer=customer
+    ):
+        pending += chunk
+        paragraphs, sep, pending = pending.rpartition("\n\n")
+        if sep and paragraphs.strip():
+            await send(paragraphs.strip())
+    if pending.strip():
+        await send(pending.strip())
+    
+    return "\n\n".join(sent)
@@ -43,6 +43,8 @@ class Settings(BaseSettings):
     # --- Gemini (LLM) ---
     GOOGLE_API_KEY: str = Field(alias="GEMINI_API_KEY")
     GEMINI_MODEL: str
+    GEMINI_RPM: int = 0  # Límite local de peticiones/min a Gemini (0 = sin límite)
+    GEMINI_TPM: int = 0  # Límite local de tokens de entrada/min a Gemini (0 = sin límite)
     
     # --- Google Calendar ---
     GOOGLE_CREDENTIALS_PATH: str
@@ -65,6 +67,9 @@ class Settings(BaseSettings):
     # --- Bot ---
     SESSION_EXPIRE_SECONDS: int
     MAX_CONTEXT_MESSAGES: int
+    MAX_HISTORY_MESSAGES: int = 12  # Mensajes de historial (usuario y bot, ~6 turnos) que se envían a Gemini por request
+    LLM_CACHE_TTL_SECONDS: int = 3600  # Caché de respuestas de Gemini en Redis (app/services/llm_cache.py)
+    WHATSAPP_STREAM_REPLIES: bool = False  # Enviar la respuesta por párrafos a medida que Gemini la genera
     
     # --- Seguridad ---
     ADMIN_API_KEY: str | None = None
@@ -1,7 +1,12 @@
+import logging
+
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app.core.config import settings
 
+logger = logging.getLogger(__name__)
+
 # Motor de base de datos asíncrono
 engine = create_async_engine(
     settings.DATABASE_URL,
@@ -23,6 +28,14 @@ AsyncSessionLocal = sessionmaker(
 # Base para los modelos
 Base = declarative_base()
 
+# Índices agregados después de crear las tablas: create_all no toca tablas que ya
+# existen, así que en bases existentes se crean aquí (CONCURRENTLY: sin bloquear escrituras)
+_POST_CREATE_INDEXES = (
+    # Ventanas de recordatorio/confirmación del scheduler (ver Appointment.__table_args__)
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS appointments_reminder_idx "
+    "ON appointments (start_time) WHERE status = 'CONFIRMED'",
+)
+
 
 async def init_db():
     """
@@ -31,3 +44,13 @@ async def init_db():
     """
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    
+    # CREATE INDEX CONCURRENTLY no puede ir dentro de una transacción
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for ddl in _POST_CREATE_INDEXES:
+            try:
+                await conn.execute(text(ddl))
+            except Exception as e:
+                # Ej. otro worker creándolo a la vez: no impide arrancar
+                logger.warning("No se pudo crear índice (%s): %s", ddl, e)
@@ -66,6 +66,42 @@ def get_redis() -> redis.Redis:
     return redis_client
 
 
+def _chat_key(client_id: int, phone_number: str) -> str:
+    """Key base de una conversación en Redis."""
+    return f"chat:{client_id}:{phone_number}"
+
+
+# message_id enviados por el bot que todavía no están en Redis (encolados para el
+# próximo pipeline o guardándose). is_message_sent_by_bot los reconoce igual: el eco
+# del webhook de Meta puede llegar antes que el guardado.
+_unsaved_sent_ids: set[str] = set()
+
+
+def add_unsaved_sent_message_id(message_id: str):
+    """Registra un message_id enviado que se guardará después con save_sent_message_ids."""
+    _unsaved_sent_ids.add(message_id)
+
+
+async def save_sent_message_ids(entries: list[tuple[int, str, str]]):
+    """
+    Guarda varios message_id enviados por el bot en un solo round-trip (pipeline).
+    
+    Args:
+        entries: Tuplas (client_id, phone_number, message_id)
+    """
+    sent: dict[str, list[str]] = {}
+    for client_id, phone_number, message_id in entries:
+        sent.setdefault(f"{_chat_key(client_id, phone_number)}:sent_messages", []).append(message_id)
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for sent_key, message_ids in sent.items():
+                pipe.sadd(sent_key, *message_ids)
+                pipe.expire(sent_key, settings.SESSION_EXPIRE_SECONDS)
+            await pipe.execute()
+    finally:
+        _unsaved_sent_ids.difference_update(message_id for _, _, message_id in entries)
+
+
 class ConversationMemory:
     """
     Maneja la memoria de conversaciones en Redis.
@@ -78,7 +114,7 @@ class ConversationMemory:
             client_id: ID del cliente (tenant)
             phone_number: Número de teléfono del usuario
         """
-        self.key = f"chat:{client_id}:{phone_number}"
+        self.key = _chat_key(client_id, phone_number)
         self.redis = get_redis()
     
     async def add_message(self, role: str, content: str):
@@ -93,13 +129,20 @@ class ConversationMemory:
             "role": role,
             "content": content
         })
-        await self.redis.rpush(self.key, message)
-        
-        # Mantener solo los últimos N mensajes
-        await self.redis.ltrim(self.key, -settings.MAX_CONTEXT_MESSAGES, -1)
-        
-        # Renovar TTL
-        await self.redis.expire(self.key, settings.SESSION_EXPIRE_SECONDS)
+        await self._append(message)
+    
+    async def _append(self, message: str):
+        """
+        Agrega un mensaje ya serializado, recorta a los últimos N y renueva el TTL
+        en un solo round-trip (pipeline).
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(self.key, message)
+            # Mantener solo los últimos N mensajes
+            pipe.ltrim(self.key, -settings.MAX_CONTEXT_MESSAGES, -1)
+            # Renovar TTL
+            pipe.expire(self.key, settings.SESSION_EXPIRE_SECONDS)
+            await pipe.execute()
     
     async def get_history(self) -> list[dict]:
         """
@@ -121,15 +164,21 @@ class ConversationMemory:
         
         Returns:
             Lista de mensajes formateados para la API de Gemini
+            (solo mensajes con texto; "parts" siempre es [{"text": str}])
         """
         history = await self.get_history()
         # Gemini usa "user" y "model" como roles
         formatted = []
         for msg in history:
-            role = "model" if msg["role"] == "assistant" else "user"
+            content = msg.get("content")
+            if not isinstance(content, str):
+                content = "" if content is None else str(content)
+            if not content or content.isspace():
+                continue
+            role = "model" if msg.get("role") == "assistant" else "user"
             formatted.append({
                 "role": role,
-                "parts": [{"text": msg["content"]}]
+                "parts": [{"text": content}]
             })
         return formatted
     
@@ -222,20 +271,7 @@ class ConversationMemory:
             "human": True,
             "admin": admin_name
         })
-        await self.redis.rpush(self.key, message)
-        await self.redis.ltrim(self.key, -settings.MAX_CONTEXT_MESSAGES, -1)
-        await self.redis.expire(self.key, settings.SESSION_EXPIRE_SECONDS)
-    
-    async def save_sent_message_id(self, message_id: str):
-        """
-        Guarda el message_id de un mensaje enviado por el bot.
-        
-        Args:
-            message_id: ID del mensaje enviado
-        """
-        sent_key = f"{self.key}:sent_messages"
-        await self.redis.sadd(sent_key, message_id)
-        await self.redis.expire(sent_key, settings.SESSION_EXPIRE_SECONDS)
+        await self._append(message)
     
     async def is_message_sent_by_bot(self, message_id: str) -> bool:
         """
@@ -247,5 +283,7 @@ class ConversationMemory:
         Returns:
             True si el mensaje fue enviado por el bot
         """
+        if message_id in _unsaved_sent_ids:
+            return True
         sent_key = f"{self.key}:sent_messages"
         return await self.redis.sismember(sent_key, message_id)
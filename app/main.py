@@ -93,10 +93,15 @@ async def lifespan(app: FastAPI):
     # Detener scheduler automático
     await stop_scheduler()
     
-    # Cerrar cliente HTTP de WhatsApp
-    from app.services.whatsapp import whatsapp_service
+    # Guardar message_id enviados pendientes y cerrar cliente HTTP de WhatsApp
+    from app.services.whatsapp import flush_sent_ids, whatsapp_service
+    await flush_sent_ids()
     await whatsapp_service.close()
     
+    # Cerrar cliente HTTP de Gemini
+    from app.services.gemini import gemini_service
+    await gemini_service.close()
+    
     await close_redis()
     logger.info("Conexiones cerradas")
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Boolean, JSON
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Boolean, JSON, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.core.database import Base
@@ -89,3 +89,12 @@ class Appointment(Base):
     
     client = relationship("Client", back_populates="appointments")
     customer = relationship("Customer", back_populates="appointments")
+
+    __table_args__ = (
+        # Ventanas de recordatorio/confirmación del scheduler: solo citas CONFIRMED por start_time
+        Index(
+            "appointments_reminder_idx",
+            "start_time",
+            postgresql_where=text("status = 'CONFIRMED'"),
+        ),
+    )
@@ -64,12 +64,11 @@ async def get_catalog_text(client_id: int, config: dict) -> str | None:
     # 2) Descargar PDF
     pdf_bytes: bytes | None = None
     if pdf_url:
-        import httpx
+        from app.services.whatsapp import whatsapp_service
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client_http:
-                r = await client_http.get(pdf_url)
-                r.raise_for_status()
-                pdf_bytes = r.content
+            r = await whatsapp_service.http_client.get(pdf_url)
+            r.raise_for_status()
+            pdf_bytes = r.content
         except Exception as e:
             logger.error("Error descargando catalog_pdf_url para client %s: %s", client_id, e)
             return None
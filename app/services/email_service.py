@@ -8,11 +8,62 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
+from functools import lru_cache
 
 from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+_DIAS_ES = ('Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo')
+_MESES_ES = (
+    'enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
+    'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre'
+)
+
+
+def _format_fecha_es(appointment_date: datetime) -> str:
+    """Ej. "Lunes 3 de marzo de 2025 a las 02:30 PM" (sin strftime ni locale)."""
+    hour = appointment_date.hour
+    hora = f"{(hour % 12) or 12:02d}:{appointment_date.minute:02d} {'AM' if hour < 12 else 'PM'}"
+    return (
+        f"{_DIAS_ES[appointment_date.weekday()]} {appointment_date.day} de "
+        f"{_MESES_ES[appointment_date.month - 1]} de {appointment_date.year} a las {hora}"
+    )
+
+
+# Plantilla del correo de recordatorio (el scheduler la usa en cada cita)
+_REMINDER_HTML = """
+            <!DOCTYPE html>
+            <html>
+            <head><meta charset="UTF-8"></head>
+            <body style="font-family: 'Segoe UI', Arial, sans-serif; line-height: 1.6; color: #333;">
+                <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
+                    <div style="background: #f0f4f8; padding: 20px; border-radius: 8px;">
+                        <h2 style="margin-top: 0;">Recordatorio de cita</h2>
+                        <p>Hola <strong>{customer_name}</strong>,</p>
+                        <p>Te recordamos que tienes una cita programada en <strong>{business_name}</strong>:</p>
+                        <p><strong>Fecha y hora:</strong> {fecha_formateada}</p>
+                        <p><strong>Servicio:</strong> {servicio}</p>
+                        {profesional_html}
+                        <p>Si necesitas cancelar o modificar, contáctanos por WhatsApp.</p>
+                        <p>¡Te esperamos!</p>
+                    </div>
+                    <p style="color: #888; font-size: 12px;">{business_name}</p>
+                </div>
+            </body>
+            </html>
+            """
+
+
+@lru_cache(maxsize=256)
+def _reminder_template(business_name: str):
+    """
+    Plantilla del recordatorio con las partes del negocio ya renderizadas (una vez por negocio):
+    por cita solo se completan los datos del cliente.
+    """
+    escaped = business_name.replace('{', '{{').replace('}', '}}')
+    return _REMINDER_HTML.replace('{business_name}', escaped).format
+
 
 class EmailService:
     """Servicio para enviar emails de confirmación."""
@@ -86,17 +137,7 @@ class EmailService:
         
         try:
             # Formatear fecha en español
-            dias = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
-            meses = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 
-                     'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
-            
-            dia_semana = dias[appointment_date.weekday()]
-            dia = appointment_date.day
-            mes = meses[appointment_date.month - 1]
-            año = appointment_date.year
-            hora = appointment_date.strftime("%I:%M %p")
-            
-            fecha_formateada = f"{dia_semana} {dia} de {mes} de {año} a las {hora}"
+            fecha_formateada = _format_fecha_es(appointment_date)
             
             # Generar contenido según tipo de negocio
             subject, html_content = self._generate_email_content(
@@ -156,41 +197,19 @@ class EmailService:
             return False
         
         try:
-            dias = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
-            meses = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
-                     'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
-            dia_semana = dias[appointment_date.weekday()]
-            dia = appointment_date.day
-            mes = meses[appointment_date.month - 1]
-            año = appointment_date.year
-            hora = appointment_date.strftime("%I:%M %p")
-            fecha_formateada = f"{dia_semana} {dia} de {mes} de {año} a las {hora}"
+            fecha_formateada = _format_fecha_es(appointment_date)
             
             subject = f"Recordatorio de cita - {business_name}"
             if hours_before >= 48:
                 subject = f"Confirmación de cita - {business_name}"
             
-            html = f"""
-            <!DOCTYPE html>
-            <html>
-            <head><meta charset="UTF-8"></head>
-            <body style="font-family: 'Segoe UI', Arial, sans-serif; line-height: 1.6; color: #333;">
-                <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
-                    <div style="background: #f0f4f8; padding: 20px; border-radius: 8px;">
-                        <h2 style="margin-top: 0;">Recordatorio de cita</h2>
-                        <p>Hola <strong>{customer_name}</strong>,</p>
-                        <p>Te recordamos que tienes una cita programada en <strong>{business_name}</strong>:</p>
-                        <p><strong>Fecha y hora:</strong> {fecha_formateada}</p>
-                        <p><strong>Servicio:</strong> {appointment_details.get('servicio', 'Cita')}</p>
-                        {f'<p><strong>Profesional:</strong> {appointment_details.get("profesional", "")}</p>' if appointment_details.get('profesional') else ''}
-                        <p>Si necesitas cancelar o modificar, contáctanos por WhatsApp.</p>
-                        <p>¡Te esperamos!</p>
-                    </div>
-                    <p style="color: #888; font-size: 12px;">{business_name}</p>
-                </div>
-            </body>
-            </html>
-            """
+            profesional = appointment_details.get('profesional')
+            html = _reminder_template(business_name)(
+                customer_name=customer_name,
+                fecha_formateada=fecha_formateada,
+                servicio=appointment_details.get('servicio', 'Cita'),
+                profesional_html=f'<p><strong>Profesional:</strong> {profesional}</p>' if profesional else '',
+            )
             
             msg = MIMEMultipart('alternative')
             msg['Subject'] = subject
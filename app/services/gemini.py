@@ -1,14 +1,255 @@
 from google import genai
 from google.genai import types
 import asyncio
+import httpx
+import json
 import logging
-from datetime import datetime, timedelta
+import re
+import sys
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from datetime import date, datetime
+from functools import lru_cache
 
+from app.agents.tools.definitions import TOOL_DEFINITIONS, ToolExecutor
 from app.core.config import settings
 from app.models.tables import Client, Customer
+from app.services.inflight import InflightCoalescer
+from app.services.llm_cache import chat_response_cache, normalize_text
+from app.services.ratelimit import estimate_media_tokens, estimate_tokens, gemini_rate_limiter
 
 logger = logging.getLogger(__name__)
 
+# Roles de Gemini (internados: el historial llega de JSON con strings nuevos)
+_ROLE_USER = sys.intern("user")
+_ROLE_MODEL = sys.intern("model")
+
+# Mensajes de respaldo (el prefijo de "sin contenido" dispara el reintento en chat_with_tools)
+_FALLBACK_NO_CONTENT_PREFIX = "Lo siento, no pude procesar tu solicitud"
+_FALLBACK_NO_CONTENT = sys.intern(f"{_FALLBACK_NO_CONTENT_PREFIX}. ¿Podrías intentarlo de nuevo?")
+_FALLBACK_NO_CANDIDATES = sys.intern(f"{_FALLBACK_NO_CONTENT_PREFIX}. ¿Podrías reformularla?")
+_FALLBACK_ERROR = sys.intern("Error procesando el mensaje.")
+
+# Limpieza de markdown para WhatsApp (reemplazos por plantilla: todo el trabajo en C)
+# "**" → "*" (el grupo captura un solo "*"); "```" → "" (grupo sin match)
+_MARKDOWN_RE = re.compile(r'\*(\*)|```')
+# "## Título  " → "*Título*"
+_HEADER_RE = re.compile(r'^#+[^\S\n]*(.*?)[^\S\n]*$', re.M)
+
+
+def _request_tokens(contents: str | list, config: types.GenerateContentConfig | None = None) -> int:
+    """Tokens de entrada aproximados de una petición (texto de contents + system_instruction)."""
+    if isinstance(contents, str):
+        texts = [contents]
+    else:
+        texts = [part.text for content in contents for part in (content.parts or ())]
+    if config is not None and isinstance(config.system_instruction, str):
+        texts.append(config.system_instruction)
+    return estimate_tokens(*texts)
+
+
+@lru_cache(maxsize=512)
+def _joined_names(names: tuple[str, ...]) -> str:
+    """Une nombres (profesionales, categorías) separados por coma. Cacheado por tupla."""
+    return ', '.join(names)
+
+
+# Nombres de días indexados por date.weekday() (0=Lunes) y abreviaturas por día laborable (1=Lunes)
+_WEEKDAY_NAMES_ES = ("Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo")
+_WEEKDAY_ABBR_ES = {1: 'Lun', 2: 'Mar', 3: 'Mié', 4: 'Jue', 5: 'Vie', 6: 'Sáb', 7: 'Dom'}
+
+
+@lru_cache(maxsize=128)
+def _joined_working_days(days: tuple[int, ...]) -> str:
+    """Convierte días laborables (1=Lunes ... 7=Domingo) a texto en español."""
+    return ', '.join(_WEEKDAY_NAMES_ES[d - 1] if isinstance(d, int) and 1 <= d <= 7 else '' for d in days)
+
+
+_DIAS_SEMANA_ES = ('lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo')
+_MESES_ES = (
+    'enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
+    'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre'
+)
+
+
+@lru_cache(maxsize=2)
+def _compute_date_strings(ordinal: int) -> tuple[str, ...]:
+    """
+    Fechas ISO relativas a un día dado (date.toordinal()):
+    (hoy, mañana, pasado mañana, próximo lunes, ..., próximo domingo).
+    Cacheado: el resultado es el mismo para todos los mensajes del día.
+    """
+    # Aritmética de ordinales: "próximo X" es siempre estrictamente posterior a hoy
+    base_dow = date.fromordinal(ordinal).weekday()
+    offsets = [0, 1, 2]
+    offsets.extend((d - base_dow) % 7 or 7 for d in range(7))
+    return tuple(date.fromordinal(ordinal + off).isoformat() for off in offsets)
+
+
+def _product_line(p: dict, currency: str) -> str:
+    """Línea de un producto del catálogo para el system prompt."""
+    precio = f"{currency}{p['price']:,}" if p.get('price') else 'Consultar'
+    desc = f" - {p['description']}" if p.get('description') else ""
+    return f"  - {p['name']}: {precio}{desc}"
+
+
+def _professional_line(p: dict, currency: str) -> str:
+    """Línea (dos renglones) de un profesional para el system prompt."""
+    # Días de trabajo del profesional
+    dias = ", ".join(_WEEKDAY_ABBR_ES.get(d, str(d)) for d in p.get("working_days", []))
+    # Horario del profesional
+    hours = p.get("business_hours", {})
+    horario = f"{hours.get('start', '08:00')} - {hours.get('end', '17:00')}"
+    # Precio de consulta
+    precio = p.get("consultation_price", 0)
+    precio_str = f" | Consulta: {currency}{precio:,}" if precio else ""
+    # Duración de cita
+    duracion = p.get("slot_duration", 30)
+    return (
+        f"  - *{p['name']}* ({p.get('specialty', 'General')}){precio_str}\n"
+        f"    📅 Días: {dias} | 🕐 Horario: {horario} | ⏱️ {duracion} min"
+    )
+
+
+# Instrucciones por tipo de negocio (se rellenan con str.format al armar el prompt)
+# Regla compartida por los flujos con citas (clínica, general, restaurante)
+_RULE_MODIFY_CANCEL = "- Modificar/cancelar: pide correo primero\n"
+
+_TPL_SALON = """
+═══════════════════════════════════════════════════
+NEGOCIO DE SERVICIOS (Detailing, spa, taller)
+═══════════════════════════════════════════════════
+
+⚠️ REGLA #1 - SIEMPRE PRIMERO:
+Cuando el cliente quiere agendar pero NO especificó el servicio exacto:
+→ Usa ver_servicios para mostrar las opciones disponibles
+→ Pregunta cuál servicio quiere
+→ NO pidas correo ni datos hasta que el cliente elija un servicio
+
+Después de saber el servicio:
+1. Pide nombre y correo (o teléfono)
+2. Pregunta fecha/hora → buscar_disponibilidad
+3. Crea la cita con crear_cita
+"""
+
+_TPL_CLINIC = """
+═══════════════════════════════════════════════════
+INSTRUCCIONES - CLÍNICA/CONSULTORIO
+═══════════════════════════════════════════════════
+
+FLUJO DE CITA:
+1. Pregunta tipo de consulta si no lo dijo
+2. Recopila: nombre, correo o teléfono{prof_note}
+3. Usa buscar_disponibilidad para verificar fecha/hora
+4. Usa crear_cita solo después de verificar disponibilidad
+5. Confirma: "Te envío confirmación a [correo]"
+
+REGLAS:
+- NUNCA des consejos médicos ni diagnósticos
+- Emergencias → escala a humano INMEDIATAMENTE
+""" + _RULE_MODIFY_CANCEL
+
+_TPL_STORE = """
+═══════════════════════════════════════════════════
+INSTRUCCIONES - TIENDA / CATÁLOGO (SIN CITAS OBLIGATORIAS)
+═══════════════════════════════════════════════════
+(Tienda, concesionario, colchonería, etc.: mostrar catálogo; visitas sin cita; entregas opcionales con pago contra entrega)
+
+TU PRINCIPAL FUNCIÓN:
+- Responder preguntas sobre productos del catálogo (ver_servicios). Los productos están disponibles; si el negocio tiene entregas, también a domicilio con pago contra entrega.
+- Si el negocio es de visita física: el cliente puede decir que va a pasar. Responde con horarios y "Puedes pasar cuando quieras", "Te esperamos". NO obligues a agendar solo para informarse o ir a ver.
+- Si el negocio ofrece entrega a domicilio: menciónalo al mostrar catálogo y ofrece agendar entrega cuando quieran comprar (pago contra entrega).
+{delivery_info}
+
+CONSULTA DE PRODUCTOS:
+1. Cliente pregunta por producto, categoría, precios
+2. Usa ver_servicios para mostrar opciones, precios, descripciones
+3. Si tiene entregas: opcionalmente añade que están disponibles con entrega a domicilio (pago contra entrega)
+
+FLUJO DE COMPRA/ENTREGA (cuando el negocio tiene entregas y el cliente quiere entrega):
+1. Cliente muestra interés en comprar y quiere entrega a domicilio
+2. Recopila: nombre, correo, producto(s), dirección, fecha/hora entrega
+3. Confirma: "Te enviaremos la confirmación a [correo]. Pago contra entrega."
+4. NO agendes entrega si solo piden información o ir a ver al local
+
+MODIFICAR/CANCELAR ENTREGA:
+- Pregunta correo primero. Busca por fecha/producto. Confirma envío de confirmación
+
+REGLAS:
+- Catálogo con ver_servicios. Visitas sin cita: horarios + "puedes pasar cuando quieras" si aplica
+- Financiamiento o pagos complejos → escala a humano. Emojis moderados (📦 🚚 ✅)
+{catalog_info}
+"""
+
+_TPL_GENERAL = """
+═══════════════════════════════════════════════════
+INSTRUCCIONES - CITAS BÁSICAS
+═══════════════════════════════════════════════════
+
+FLUJO DE CITA:
+1. Recopila: nombre, correo o teléfono{prof_note}
+2. Usa buscar_disponibilidad para verificar fecha/hora
+3. Usa crear_cita solo después de verificar disponibilidad
+4. Confirma: "Te envío confirmación a [correo]"
+
+REGLAS:
+- buscar_disponibilidad ANTES de confirmar
+""" + _RULE_MODIFY_CANCEL
+
+_TPL_RESTAURANT = """
+═══════════════════════════════════════════════════
+INSTRUCCIONES - RESTAURANTE
+═══════════════════════════════════════════════════
+
+FLUJO DE RESERVACIÓN:
+1. Recopila: nombre, correo o teléfono, número de personas
+2. Pregunta fecha/hora preferida
+3. Usa buscar_disponibilidad ANTES de confirmar
+4. Usa crear_cita con num_personas
+5. Confirma: "Te envío confirmación a [correo]"
+
+OPCIONES:
+- Áreas: {areas_str}
+- Ocasiones especiales: pregunta si aplica
+
+REGLAS:
+- Grupos 8+ personas → escala a humano
+""" + _RULE_MODIFY_CANCEL
+
+_BUSINESS_TYPE_TEMPLATES = {
+    'salon': _TPL_SALON,
+    'clinic': _TPL_CLINIC,
+    'store': _TPL_STORE,
+    'general': _TPL_GENERAL,
+    'restaurant': _TPL_RESTAURANT,
+}
+
+_STORE_CATALOG_PDF = """
+CATÁLOGO (PDF):
+- El catálogo del negocio está en un documento PDF. Cuando pregunten por productos, precios, qué tienen, cuánto cuesta X, etc., usa ver_servicios y pasa en el parámetro "pregunta" exactamente lo que el usuario preguntó (ej. "¿Qué colchones tienen?", "precios de almohadas", "cuánto cuesta el modelo Y"). La IA responderá basándose en el PDF.
+"""
+
+_STORE_CATALOG_CATEGORIES = """
+CATÁLOGO:
+- Categorías: {categories}
+- Preguntas por productos/modelos → usa ver_servicios (puedes filtrar por categoría)
+"""
+
+_STORE_DELIVERY_YES = """
+ENTREGA A DOMICILIO (PAGO CONTRA ENTREGA):
+- Este negocio SÍ ofrece entrega a domicilio con pago contra entrega.
+- Cuando muestres el catálogo o pregunten por productos, puedes mencionar brevemente: "Todos nuestros productos están disponibles con entrega a domicilio (pago contra entrega). ¿Te gustaría ver opciones o agendar una entrega?"
+- Si preguntan "¿hacen envíos?", "¿entregan?", "¿pago contra entrega?": responde que sí y ofrece agendar la entrega (nombre, correo, producto, dirección, fecha/hora).
+"""
+
+_STORE_DELIVERY_NO = """
+ENTREGA A DOMICILIO:
+- Este negocio NO tiene entregas a domicilio configuradas. Solo ofrece catálogo y visita al local.
+- No ofrezcas agendar entrega. Si preguntan por envíos, indica que pueden pasar al local según horarios de atención.
+"""
+
 
 class GeminiService:
     """
@@ -16,9 +257,106 @@ class GeminiService:
     Soporta Function Calling para ejecutar herramientas.
     """
     
+    # Config base de chat_simple (el system prompt se agrega por llamada)
+    _SIMPLE_CONFIG = types.GenerateContentConfig(
+        temperature=0.5,
+        max_output_tokens=1024,
+    )
+    
+    # Parámetros de generación de chat_with_tools (system prompt o caché se agregan por llamada)
+    _TOOLS_CFG_KWARGS = dict(temperature=0.5, top_p=0.95, max_output_tokens=1024)
+    
+    # Config de las llamadas de seguimiento tras ejecutar herramientas
+    _FOLLOWUP_CONFIG = types.GenerateContentConfig(
+        temperature=0.5,
+        max_output_tokens=1024,
+        tools=TOOL_DEFINITIONS,
+    )
+    
+    # Caché explícito de Gemini (cached_content) para system prompts estables
+    _PROMPT_CACHE_TTL_SECONDS = 600
+    _PROMPT_CACHE_MAX_ENTRIES = 256
+    
+    # Caché en memoria de la parte estática del system prompt
+    _STATIC_PROMPT_TTL_SECONDS = 300
+    _STATIC_PROMPT_MAX_ENTRIES = 256
+    
+    # Plazo total de espera a Gemini en las respuestas en streaming (igual que wait_for en el resto)
+    _STREAM_TIMEOUT_SECONDS = 30.0
+    
     def __init__(self):
-        self.client = genai.Client(api_key=settings.GOOGLE_API_KEY)
+        # Pool acotado con keepalive y HTTP/2: las llamadas concurrentes reutilizan
+        # conexiones en lugar de renegociar TLS. Se pasa como cliente httpx explícito
+        # (con aiohttp instalado, el SDK ignoraría limits/http2 de async_client_args)
+        self._http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=64,
+                max_keepalive_connections=32,
+                keepalive_expiry=60,
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+        self.client = genai.Client(
+            api_key=settings.GOOGLE_API_KEY,
+            http_options=types.HttpOptions(httpx_async_client=self._http_client),
+        )
         self.model = settings.GEMINI_MODEL
+        # hash(system_prompt) -> (nombre del CachedContent o None, válido hasta [monotonic])
+        self._prompt_caches: OrderedDict[tuple[int, bool], tuple[str | None, float]] = OrderedDict()
+        self._prompt_cache_creates = InflightCoalescer()
+        # (hash(system_prompt), hash(context_key), hash(message)) -> respuesta en curso de chat_simple
+        self._inflight = InflightCoalescer()
+        # (client.id, hash de la config) -> (válido hasta [monotonic], (inicio, final))
+        self._static_prompts: dict[tuple[int, int], tuple[float, tuple[str, str]]] = {}
+    
+    async def close(self):
+        """Cierra el cliente HTTP de Gemini. Llamar al cerrar la aplicación."""
+        await self._http_client.aclose()
+    
+    async def _get_prompt_cache(self, system_prompt: str, tools: list | None = None) -> str | None:
+        """
+        Devuelve el nombre de un CachedContent de Gemini con el system prompt
+        (y las tools, si se pasan; Gemini no permite mandarlas aparte junto al caché).
+        Se crea en el primer uso y se reutiliza hasta poco antes de expirar.
+        Retorna None si el prompt no se puede cachear (ej. no alcanza el mínimo de tokens).
+        """
+        key = (hash(system_prompt), tools is not None)
+        entry = self._prompt_caches.get(key)
+        if entry and entry[1] > time.monotonic():
+            self._prompt_caches.move_to_end(key)
+            return entry[0]
+        # Mensajes simultáneos con el mismo prompt comparten un solo caches.create
+        return await self._prompt_cache_creates.run(
+            key, lambda: self._create_prompt_cache(key, system_prompt, tools)
+        )
+    
+    async def _create_prompt_cache(
+        self, key: tuple[int, bool], system_prompt: str, tools: list | None
+    ) -> str | None:
+        """Crea el CachedContent (ver _get_prompt_cache) y lo recuerda en _prompt_caches."""
+        now = time.monotonic()
+        try:
+            cache = await self.client.aio.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_prompt,
+                    tools=tools,
+                    ttl=f"{self._PROMPT_CACHE_TTL_SECONDS}s",
+                )
+            )
+            cache_name = cache.name
+        except Exception as e:
+            # Se recuerda el fallo para no reintentar en cada mensaje
+            logger.debug("No se pudo crear caché de prompt en Gemini: %s", e)
+            cache_name = None
+        
+        # Margen de 60s para no usar un caché a punto de expirar
+        self._prompt_caches[key] = (cache_name, now + self._PROMPT_CACHE_TTL_SECONDS - 60)
+        self._prompt_caches.move_to_end(key)
+        while len(self._prompt_caches) > self._PROMPT_CACHE_MAX_ENTRIES:
+            self._prompt_caches.popitem(last=False)
+        return cache_name
     
     async def build_system_prompt(
         self,
@@ -28,22 +366,54 @@ class GeminiService:
         """
         Construye el system prompt completo y profesional para el agente.
         Adaptado según el tipo de negocio y su configuración.
+        La parte estática (negocio, reglas, catálogo) se cachea por cliente;
+        solo la información del cliente y las fechas se arman en cada mensaje.
+        """
+        head, tail = await self._get_static_sections(client)
+        return head + self._build_dynamic_section(customer, datetime.now()) + tail
+    
+    async def _get_static_sections(self, client: Client) -> tuple[str, str]:
+        """
+        Devuelve (inicio, final) estáticos del system prompt, cacheados por
+        (client.id, configuración) durante _STATIC_PROMPT_TTL_SECONDS.
         """
         config = client.tools_config or {}
-        business_type = config.get('business_type', 'general')
-        now = datetime.now()
+        key = (
+            client.id,
+            hash((
+                client.business_name,
+                client.system_prompt_template,
+                json.dumps(config, sort_keys=True, default=str),
+            )),
+        )
+        now = time.monotonic()
+        entry = self._static_prompts.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
         
-        # Días de la semana en español
-        dias_es = {
-            'Monday': 'Lunes', 'Tuesday': 'Martes', 'Wednesday': 'Miércoles',
-            'Thursday': 'Jueves', 'Friday': 'Viernes', 'Saturday': 'Sábado', 'Sunday': 'Domingo'
-        }
-        dia_actual = dias_es.get(now.strftime("%A"), now.strftime("%A"))
+        sections = await self._build_static_sections(client)
+        self._static_prompts.pop(key, None)
+        self._static_prompts[key] = (now + self._STATIC_PROMPT_TTL_SECONDS, sections)
+        while len(self._static_prompts) > self._STATIC_PROMPT_MAX_ENTRIES:
+            self._static_prompts.pop(next(iter(self._static_prompts)))
+        return sections
+    
+    async def _build_static_sections(self, client: Client) -> tuple[str, str]:
+        """
+        Arma las secciones del system prompt que solo dependen del negocio:
+        el inicio (comportamiento, info del negocio, reglas, catálogo, tipo de negocio)
+        y el final (instrucciones del dueño, que siempre van al final).
+        """
+        config = client.tools_config or {}
+        business_type = config.get('business_type', 'general')
+        profs_tuple = tuple(p.get('name', '') for p in config.get('professionals') or ())
+        working_days_str = _joined_working_days(tuple(config.get('working_days', (1, 2, 3, 4, 5))))
         
         # ==========================================
         # PROMPT BASE - COMPORTAMIENTO PROFESIONAL
         # ==========================================
-        base_system = f"""Eres el asistente virtual de *{client.business_name}*. Tu objetivo es brindar una atención profesional, cálida y eficiente.
+        parts: list[str] = []
+        parts.append(f"""Eres el asistente virtual de *{client.business_name}*. Tu objetivo es brindar una atención profesional, cálida y eficiente.
 
 ═══════════════════════════════════════════════════
 REGLAS FUNDAMENTALES DE COMPORTAMIENTO
@@ -94,9 +464,7 @@ INFORMACIÓN DEL NEGOCIO
 ═══════════════════════════════════════════════════
 
 Nombre: {client.business_name}
-Fecha actual: {dia_actual} {now.strftime("%d de %B de %Y")}
-Hora actual: {now.strftime("%H:%M")}
-"""
+""")
 
         # ==========================================
         # AGREGAR INFO SEGÚN TIPO DE NEGOCIO
@@ -105,13 +473,10 @@ Hora actual: {now.strftime("%H:%M")}
         # Horario de atención
         if 'business_hours' in config:
             hours = config['business_hours']
-            dias_trabajo = config.get('working_days', [1,2,3,4,5])
-            dias_nombres = {1:'Lunes', 2:'Martes', 3:'Miércoles', 4:'Jueves', 5:'Viernes', 6:'Sábado', 7:'Domingo'}
-            dias_str = ', '.join([dias_nombres.get(d, '') for d in dias_trabajo])
-            base_system += f"""
+            parts.append(f"""
 Horario: {hours.get('start', '08:00')} - {hours.get('end', '18:00')}
-Días de atención: {dias_str}
-"""
+Días de atención: {working_days_str}
+""")
 
         # PRIORIZAR catálogo sobre servicios genéricos
         # Si existe catalog con productos, mostrar esos en lugar del array "services"
@@ -120,61 +485,41 @@ Días de atención: {dias_str}
         if 'catalog' in config:
             cats = config['catalog'].get('categories', [])
             if cats:
-                services_list = []
-                for cat in cats:
-                    for p in cat.get('products', []):
-                        precio = f"{currency}{p['price']:,}" if p.get('price') else 'Consultar'
-                        desc = f" - {p['description']}" if p.get('description') else ""
-                        services_list.append(f"  - {p['name']}: {precio}{desc}")
-                if services_list:
-                    base_system += f"""
+                products_block = "\n".join(
+                    _product_line(p, currency)
+                    for cat in cats
+                    for p in cat.get('products', [])
+                )
+                if products_block:
+                    parts.append(f"""
 Servicios/Productos disponibles:
-{chr(10).join(services_list)}
-"""
+{products_block}
+""")
                 if config.get('free_delivery_minimum'):
-                    base_system += f"Envío gratis en compras mayores a {currency}{config['free_delivery_minimum']:,}\n"
+                    parts.append(f"Envío gratis en compras mayores a {currency}{config['free_delivery_minimum']:,}\n")
         # Si no hay catálogo, usar servicios (pero solo si no son genéricos/placeholder)
         elif 'services' in config:
             services = config['services']
             # Filtrar servicios genéricos/placeholder (precio 0 y nombre genérico)
             real_services = [s for s in services if s.get('price', 0) > 0 or s.get('name', '').lower() not in ['servicio', 'service']]
             if real_services:
-                services_list = []
-                for s in real_services:
-                    services_list.append(f"  - {s['name']}: {currency}{s['price']:,}")
-                base_system += f"""
+                services_block = "\n".join(f"  - {s['name']}: {currency}{s['price']:,}" for s in real_services)
+                parts.append(f"""
 Servicios y precios:
-{chr(10).join(services_list)}
-"""
+{services_block}
+""")
 
         # Profesionales (clínica multi-doctor o salón) - mostrar info detallada
         if 'professionals' in config:
-            profs_list = []
-            dias_nombres = {1:'Lun', 2:'Mar', 3:'Mié', 4:'Jue', 5:'Vie', 6:'Sáb', 7:'Dom'}
-            for p in config['professionals']:
-                # Días de trabajo del profesional
-                dias = ", ".join([dias_nombres.get(d, str(d)) for d in p.get("working_days", [])])
-                # Horario del profesional
-                hours = p.get("business_hours", {})
-                horario = f"{hours.get('start', '08:00')} - {hours.get('end', '17:00')}"
-                # Precio de consulta
-                precio = p.get("consultation_price", 0)
-                precio_str = f" | Consulta: {currency}{precio:,}" if precio else ""
-                # Duración de cita
-                duracion = p.get("slot_duration", 30)
-                
-                profs_list.append(
-                    f"  - *{p['name']}* ({p.get('specialty', 'General')}){precio_str}\n"
-                    f"    📅 Días: {dias} | 🕐 Horario: {horario} | ⏱️ {duracion} min"
-                )
-            base_system += f"""
+            profs_block = "\n".join(_professional_line(p, currency) for p in config['professionals'])
+            parts.append(f"""
 Profesionales disponibles:
-{chr(10).join(profs_list)}
-"""
+{profs_block}
+""")
 
         # Teléfono de contacto
         if 'contact_phone' in config:
-            base_system += f"Teléfono de contacto: {config['contact_phone']}\n"
+            parts.append(f"Teléfono de contacto: {config['contact_phone']}\n")
 
         # ==========================================
         # REGLAS INNATAS SEGÚN LA CONFIGURACIÓN (siempre aplican)
@@ -195,9 +540,8 @@ Profesionales disponibles:
                     "Cuando pregunten precios o qué tienen, usa ver_servicios."
                 )
             if has_multiple_professionals:
-                profs_names = ", ".join([p.get("name", "") for p in professionals])
                 innate_rules.append(
-                    f"El negocio tiene varios profesionales ({profs_names}). SIEMPRE pregunta con cuál quieren agendar y usa profesional_id al crear la cita. No agendes sin especificar profesional."
+                    f"El negocio tiene varios profesionales ({_joined_names(profs_tuple)}). SIEMPRE pregunta con cuál quieren agendar y usa profesional_id al crear la cita. No agendes sin especificar profesional."
                 )
                 # Agregar regla sobre horarios individuales
                 innate_rules.append(
@@ -221,32 +565,15 @@ Profesionales disponibles:
             )
 
         if innate_rules:
-            base_system += """
+            parts.append("""
 ═══════════════════════════════════════════════════
 REGLAS INNATAS (según la configuración del negocio)
 ═══════════════════════════════════════════════════
 Estas reglas aplican siempre; no dependen del tipo de negocio.
-"""
+""")
             for r in innate_rules:
-                base_system += f"- {r}\n"
-            base_system += "\n"
-
-        # ==========================================
-        # INFORMACIÓN DEL CLIENTE (si existe)
-        # ==========================================
-        if customer:
-            nombre_cliente = customer.full_name or "Cliente"
-            base_system += f"""
-═══════════════════════════════════════════════════
-INFORMACIÓN DEL CLIENTE
-═══════════════════════════════════════════════════
-Nombre: {nombre_cliente}
-Teléfono: {customer.phone_number}
-"""
-            if customer.data:
-                for key, value in customer.data.items():
-                    base_system += f"{key}: {value}\n"
-
+                parts.append(f"- {r}\n")
+            parts.append("\n")
 
         # ==========================================
         # INSTRUCCIONES SEGÚN TIPO DE NEGOCIO
@@ -261,7 +588,7 @@ Teléfono: {customer.phone_number}
             # Cargar texto del PDF y ponerlo directo en el system prompt
             from app.services.catalog_pdf import get_catalog_text
             pdf_text = await get_catalog_text(client.id, config)
-            base_system += """
+            parts.append("""
 ═══════════════════════════════════════════════════
 CATÁLOGO EN PDF (ACTIVADO)
 ═══════════════════════════════════════════════════
@@ -274,190 +601,105 @@ CATÁLOGO EN PDF (ACTIVADO)
 - Si necesitas calcular un total, suma los precios EXACTOS del catálogo.
 - JAMÁS inventes, redondees o aproximes un precio.
 - Solo usa ver_servicios si necesitas recargar el catálogo por alguna razón.
-"""
+""")
             if pdf_text:
                 # Truncar si es muy largo pero incluir siempre
                 catalog_for_prompt = pdf_text[:50000] if len(pdf_text) > 50000 else pdf_text
-                base_system += f"""
+                parts.append(f"""
 📋 CATÁLOGO COMPLETO (datos EXACTOS del PDF):
 {catalog_for_prompt}
-"""
+""")
 
 
         
-        if business_type == 'salon':
-            base_system += """
-═══════════════════════════════════════════════════
-NEGOCIO DE SERVICIOS (Detailing, spa, taller)
-═══════════════════════════════════════════════════
-
-⚠️ REGLA #1 - SIEMPRE PRIMERO:
-Cuando el cliente quiere agendar pero NO especificó el servicio exacto:
-→ Usa ver_servicios para mostrar las opciones disponibles
-→ Pregunta cuál servicio quiere
-→ NO pidas correo ni datos hasta que el cliente elija un servicio
-
-Después de saber el servicio:
-1. Pide nombre y correo (o teléfono)
-2. Pregunta fecha/hora → buscar_disponibilidad
-3. Crea la cita con crear_cita
-"""
-
-        elif business_type == 'clinic':
-            prof_note = ""
-            if config.get('professionals') and len(config['professionals']) > 1:
-                profs = ', '.join([p['name'] for p in config['professionals']])
-                prof_note = f"\n- Doctores: {profs}. Pregunta \"¿con cuál doctor?\" antes de agendar."
+        template = _BUSINESS_TYPE_TEMPLATES.get(business_type)
+        if template:
+            fields = {}
+            if business_type in ('clinic', 'general'):
+                prof_note = ""
+                if len(profs_tuple) > 1:
+                    if business_type == 'clinic':
+                        prof_note = f"\n- Doctores: {_joined_names(profs_tuple)}. Pregunta \"¿con cuál doctor?\" antes de agendar."
+                    else:
+                        prof_note = f"\n- Profesionales: {_joined_names(profs_tuple)}. Pregunta \"¿con quién?\" antes de agendar."
+                fields['prof_note'] = prof_note
             
-            base_system += f"""
-═══════════════════════════════════════════════════
-INSTRUCCIONES - CLÍNICA/CONSULTORIO
-═══════════════════════════════════════════════════
-
-FLUJO DE CITA:
-1. Pregunta tipo de consulta si no lo dijo
-2. Recopila: nombre, correo o teléfono{prof_note}
-3. Usa buscar_disponibilidad para verificar fecha/hora
-4. Usa crear_cita solo después de verificar disponibilidad
-5. Confirma: "Te envío confirmación a [correo]"
-
-REGLAS:
-- NUNCA des consejos médicos ni diagnósticos
-- Emergencias → escala a humano INMEDIATAMENTE
-- Modificar/cancelar: pide correo primero
-"""
-
-        elif business_type == 'store':
-            # Tienda / concesionario / dealer: catálogo, sin citas obligatorias. Puede ser solo info + "pásate cuando quieras"
-            catalog_info = ""
-            if config.get('catalog_source') == 'pdf':
-                catalog_info = """
-CATÁLOGO (PDF):
-- El catálogo del negocio está en un documento PDF. Cuando pregunten por productos, precios, qué tienen, cuánto cuesta X, etc., usa ver_servicios y pasa en el parámetro "pregunta" exactamente lo que el usuario preguntó (ej. "¿Qué colchones tienen?", "precios de almohadas", "cuánto cuesta el modelo Y"). La IA responderá basándose en el PDF.
-"""
-            elif config.get('catalog'):
-                categories = config['catalog'].get('categories', [])
-                if categories:
-                    cat_names = [c['name'] for c in categories]
-                    catalog_info = f"""
-CATÁLOGO:
-- Categorías: {', '.join(cat_names)}
-- Preguntas por productos/modelos → usa ver_servicios (puedes filtrar por categoría)
-"""
-            # Si tiene calendar_id, el negocio ofrece entrega a domicilio (pago contra entrega); si no, solo catálogo y visita
-            delivery_info = ""
-            if config.get('calendar_id'):
-                delivery_info = """
-ENTREGA A DOMICILIO (PAGO CONTRA ENTREGA):
-- Este negocio SÍ ofrece entrega a domicilio con pago contra entrega.
-- Cuando muestres el catálogo o pregunten por productos, puedes mencionar brevemente: "Todos nuestros productos están disponibles con entrega a domicilio (pago contra entrega). ¿Te gustaría ver opciones o agendar una entrega?"
-- Si preguntan "¿hacen envíos?", "¿entregan?", "¿pago contra entrega?": responde que sí y ofrece agendar la entrega (nombre, correo, producto, dirección, fecha/hora).
-"""
-            else:
-                delivery_info = """
-ENTREGA A DOMICILIO:
-- Este negocio NO tiene entregas a domicilio configuradas. Solo ofrece catálogo y visita al local.
-- No ofrezcas agendar entrega. Si preguntan por envíos, indica que pueden pasar al local según horarios de atención.
-"""
+            elif business_type == 'store':
+                # Tienda / concesionario / dealer: catálogo, sin citas obligatorias. Puede ser solo info + "pásate cuando quieras"
+                catalog_info = ""
+                if config.get('catalog_source') == 'pdf':
+                    catalog_info = _STORE_CATALOG_PDF
+                elif config.get('catalog'):
+                    categories = config['catalog'].get('categories', [])
+                    if categories:
+                        cat_names = tuple(c['name'] for c in categories)
+                        catalog_info = _STORE_CATALOG_CATEGORIES.format(categories=_joined_names(cat_names))
+                fields['catalog_info'] = catalog_info
+                # Si tiene calendar_id, el negocio ofrece entrega a domicilio (pago contra entrega); si no, solo catálogo y visita
+                fields['delivery_info'] = _STORE_DELIVERY_YES if config.get('calendar_id') else _STORE_DELIVERY_NO
             
-            base_system += f"""
-═══════════════════════════════════════════════════
-INSTRUCCIONES - TIENDA / CATÁLOGO (SIN CITAS OBLIGATORIAS)
-═══════════════════════════════════════════════════
-(Tienda, concesionario, colchonería, etc.: mostrar catálogo; visitas sin cita; entregas opcionales con pago contra entrega)
-
-TU PRINCIPAL FUNCIÓN:
-- Responder preguntas sobre productos del catálogo (ver_servicios). Los productos están disponibles; si el negocio tiene entregas, también a domicilio con pago contra entrega.
-- Si el negocio es de visita física: el cliente puede decir que va a pasar. Responde con horarios y "Puedes pasar cuando quieras", "Te esperamos". NO obligues a agendar solo para informarse o ir a ver.
-- Si el negocio ofrece entrega a domicilio: menciónalo al mostrar catálogo y ofrece agendar entrega cuando quieran comprar (pago contra entrega).
-{delivery_info}
-
-CONSULTA DE PRODUCTOS:
-1. Cliente pregunta por producto, categoría, precios
-2. Usa ver_servicios para mostrar opciones, precios, descripciones
-3. Si tiene entregas: opcionalmente añade que están disponibles con entrega a domicilio (pago contra entrega)
-
-FLUJO DE COMPRA/ENTREGA (cuando el negocio tiene entregas y el cliente quiere entrega):
-1. Cliente muestra interés en comprar y quiere entrega a domicilio
-2. Recopila: nombre, correo, producto(s), dirección, fecha/hora entrega
-3. Confirma: "Te enviaremos la confirmación a [correo]. Pago contra entrega."
-4. NO agendes entrega si solo piden información o ir a ver al local
-
-MODIFICAR/CANCELAR ENTREGA:
-- Pregunta correo primero. Busca por fecha/producto. Confirma envío de confirmación
-
-REGLAS:
-- Catálogo con ver_servicios. Visitas sin cita: horarios + "puedes pasar cuando quieras" si aplica
-- Financiamiento o pagos complejos → escala a humano. Emojis moderados (📦 🚚 ✅)
-{catalog_info}
-"""
-
-        elif business_type == 'general':
-            prof_note = ""
-            if config.get('professionals') and len(config['professionals']) > 1:
-                profs = ', '.join([p['name'] for p in config['professionals']])
-                prof_note = f"\n- Profesionales: {profs}. Pregunta \"¿con quién?\" antes de agendar."
+            elif business_type == 'restaurant':
+                areas_restaurante = config.get('areas', ['Salón principal'])
+                fields['areas_str'] = ' / '.join(areas_restaurante) if isinstance(areas_restaurante, list) else areas_restaurante
             
-            base_system += f"""
+            parts.append(template.format(**fields))
+
+        # ==========================================
+        # INSTRUCCIONES PERSONALIZADAS DEL NEGOCIO (PRIORIDAD MÁXIMA)
+        # ==========================================
+        # Estas instrucciones van AL FINAL para que sobrescriban cualquier regla automática
+        owner_section = ""
+        if client.system_prompt_template and client.system_prompt_template.strip():
+            owner_section = f"""
 ═══════════════════════════════════════════════════
-INSTRUCCIONES - CITAS BÁSICAS
+🔴 INSTRUCCIONES DEL DUEÑO DEL NEGOCIO (PRIORIDAD MÁXIMA)
 ═══════════════════════════════════════════════════
+Las siguientes instrucciones fueron escritas por el dueño del negocio.
+SI HAY CONFLICTO con cualquier regla anterior, ESTAS INSTRUCCIONES GANAN:
 
-FLUJO DE CITA:
-1. Recopila: nombre, correo o teléfono{prof_note}
-2. Usa buscar_disponibilidad para verificar fecha/hora
-3. Usa crear_cita solo después de verificar disponibilidad
-4. Confirma: "Te envío confirmación a [correo]"
-
-REGLAS:
-- buscar_disponibilidad ANTES de confirmar
-- Modificar/cancelar: pide correo primero
+{client.system_prompt_template}
 """
-
-        elif business_type == 'restaurant':
-            areas_restaurante = config.get('areas', ['Salón principal'])
-            areas_str = ' / '.join(areas_restaurante) if isinstance(areas_restaurante, list) else areas_restaurante
-            base_system += f"""
+        
+        return "".join(parts), owner_section
+    
+    def _build_dynamic_section(self, customer: Customer | None, now: datetime) -> str:
+        """
+        Arma la parte del system prompt que cambia en cada mensaje:
+        información del cliente y fechas relativas.
+        """
+        dia_actual = _WEEKDAY_NAMES_ES[now.weekday()]
+        parts: list[str] = []
+        
+        # ==========================================
+        # INFORMACIÓN DEL CLIENTE (si existe)
+        # ==========================================
+        if customer:
+            nombre_cliente = customer.full_name or "Cliente"
+            parts.append(f"""
 ═══════════════════════════════════════════════════
-INSTRUCCIONES - RESTAURANTE
+INFORMACIÓN DEL CLIENTE
 ═══════════════════════════════════════════════════
-
-FLUJO DE RESERVACIÓN:
-1. Recopila: nombre, correo o teléfono, número de personas
-2. Pregunta fecha/hora preferida
-3. Usa buscar_disponibilidad ANTES de confirmar
-4. Usa crear_cita con num_personas
-5. Confirma: "Te envío confirmación a [correo]"
-
-OPCIONES:
-- Áreas: {areas_str}
-- Ocasiones especiales: pregunta si aplica
-
-REGLAS:
-- Grupos 8+ personas → escala a humano
-- Modificar/cancelar: pide correo primero
-"""
-
+Nombre: {nombre_cliente}
+Teléfono: {customer.phone_number}
+""")
+            if customer.data:
+                for key, value in customer.data.items():
+                    parts.append(f"{key}: {value}\n")
+        
         # ==========================================
         # CÁLCULO DE FECHAS RELATIVAS
         # ==========================================
-        hoy = now.date()
-        manana = hoy + timedelta(days=1)
-        pasado_manana = hoy + timedelta(days=2)
+        hoy_str, manana_str, pasado_manana_str, *proximos = _compute_date_strings(
+            now.toordinal()
+        )
         
-        # Calcular próximos días de la semana
-        dias_semana_es = ['lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo']
-        proximos_dias = {}
-        for i in range(1, 8):
-            fecha_futura = hoy + timedelta(days=i)
-            dia_nombre = dias_semana_es[fecha_futura.weekday()]
-            if dia_nombre not in proximos_dias:
-                proximos_dias[dia_nombre] = fecha_futura.strftime("%Y-%m-%d")
+        # Próximos días de la semana
+        proximos_dias = dict(zip(_DIAS_SEMANA_ES, proximos))
         
         # ==========================================
         # INSTRUCCIONES TÉCNICAS (invisibles al usuario)
         # ==========================================
-        base_system += f"""
+        parts.append(f"""
 ═══════════════════════════════════════════════════
 INSTRUCCIONES TÉCNICAS (NO MENCIONAR AL USUARIO)
 ═══════════════════════════════════════════════════
@@ -465,9 +707,11 @@ INSTRUCCIONES TÉCNICAS (NO MENCIONAR AL USUARIO)
 Las REGLAS INNATAS (según la configuración del negocio) aplican siempre: si hay varios profesionales, pregunta con cuál antes de crear_cita; si hay servicios o variantes de precio, pregunta esos datos y pásalos en "detalles" o en el servicio.
 
 ⚠️ FECHAS - MUY IMPORTANTE ⚠️
-Hoy es: {hoy.strftime("%Y-%m-%d")} ({dia_actual})
-Mañana es: {manana.strftime("%Y-%m-%d")}
-Pasado mañana es: {pasado_manana.strftime("%Y-%m-%d")}
+Fecha actual: {dia_actual} {now.day:02d} de {_MESES_ES[now.month - 1]} de {now.year}
+Hora actual: {now.hour:02d}:{now.minute:02d}
+Hoy es: {hoy_str} ({dia_actual})
+Mañana es: {manana_str}
+Pasado mañana es: {pasado_manana_str}
 
 Próximos días de la semana:
 - Próximo lunes: {proximos_dias.get('lunes', 'N/A')}
@@ -481,8 +725,8 @@ Próximos días de la semana:
 ⚠️ REGLAS CRÍTICAS DE FECHAS Y HORAS ⚠️
 
 CUANDO EL USUARIO MENCIONA FECHAS RELATIVAS, DEBES CONVERTIRLAS INMEDIATAMENTE:
-- "mañana" = {manana.strftime("%Y-%m-%d")} ← USA ESTA FECHA DIRECTAMENTE
-- "pasado mañana" = {pasado_manana.strftime("%Y-%m-%d")}
+- "mañana" = {manana_str} ← USA ESTA FECHA DIRECTAMENTE
+- "pasado mañana" = {pasado_manana_str}
 - "el lunes" = {proximos_dias.get('lunes', 'N/A')}
 - "el martes" = {proximos_dias.get('martes', 'N/A')}
 - "el miércoles" = {proximos_dias.get('miércoles', 'N/A')}
@@ -498,15 +742,15 @@ CONVERSIÓN DE HORAS (24 horas):
 - "medio día" / "12 pm" = 12:00
 
 🚫 PROHIBIDO:
-- NO preguntes "¿qué día es mañana?" - YA LO SABES: es {manana.strftime("%Y-%m-%d")}
+- NO preguntes "¿qué día es mañana?" - YA LO SABES: es {manana_str}
 - NO pidas formato específico de fecha si el usuario ya dijo "mañana", "el sábado", etc.
-- NO uses años anteriores a {hoy.year}
+- NO uses años anteriores a {now.year}
 - NO inventes fechas - usa SOLO las calculadas arriba
 
 ✅ CORRECTO:
 Si el usuario dice "quiero cita para mañana a las 11 de la mañana":
-→ Usa buscar_disponibilidad con fecha={manana.strftime("%Y-%m-%d")}, hora=11:00
-→ O usa crear_cita con fecha={manana.strftime("%Y-%m-%d")}, hora=11:00
+→ Usa buscar_disponibilidad con fecha={manana_str}, hora=11:00
+→ O usa crear_cita con fecha={manana_str}, hora=11:00
 
 HERRAMIENTAS (no mencionar al usuario):
 - buscar_disponibilidad: para ver horarios libres
@@ -519,24 +763,76 @@ HERRAMIENTAS (no mencionar al usuario):
 - escalar_a_humano: para emergencias/quejas
 
 Formato WhatsApp: *negrita* _cursiva_
-"""
-
-        # ==========================================
-        # INSTRUCCIONES PERSONALIZADAS DEL NEGOCIO (PRIORIDAD MÁXIMA)
-        # ==========================================
-        # Estas instrucciones van AL FINAL para que sobrescriban cualquier regla automática
-        if client.system_prompt_template and client.system_prompt_template.strip():
-            base_system += f"""
-═══════════════════════════════════════════════════
-🔴 INSTRUCCIONES DEL DUEÑO DEL NEGOCIO (PRIORIDAD MÁXIMA)
-═══════════════════════════════════════════════════
-Las siguientes instrucciones fueron escritas por el dueño del negocio.
-SI HAY CONFLICTO con cualquier regla anterior, ESTAS INSTRUCCIONES GANAN:
-
-{client.system_prompt_template}
-"""
+""")
         
-        return base_system
+        return "".join(parts)
+    
+    @staticmethod
+    def _dynamic_cache_key(customer: Customer | None, now: datetime) -> str:
+        """
+        Clave de caché de la parte dinámica: cliente, fecha y hora sin minutos.
+        Una respuesta cacheada se reutiliza dentro de la misma hora (la sección
+        dinámica muestra HH:MM, pero cambiar de minuto no cambia la respuesta).
+        """
+        customer_part = ""
+        if customer:
+            customer_part = json.dumps(
+                [customer.full_name, customer.phone_number, customer.data],
+                sort_keys=True, default=str,
+            )
+        return f"{customer_part}|{now:%Y-%m-%d %H}"
+    
+    async def _build_tools_request(
+        self,
+        message: str,
+        history: list[dict],
+        client: Client,
+        customer: Customer
+    ) -> tuple[list, types.GenerateContentConfig]:
+        """
+        Arma contents y config para chat_with_tools / chat_with_tools_stream.
+        """
+        # La parte estática (negocio + tools) va en un CachedContent de Gemini;
+        # la dinámica (cliente y fechas) viaja en contents en cada mensaje
+        head, tail = await self._get_static_sections(client)
+        dynamic = self._build_dynamic_section(customer, datetime.now())
+        cache_name = await self._get_prompt_cache(head + tail, tools=TOOL_DEFINITIONS)
+        
+        # Construir contenido del chat
+        contents = []
+        if cache_name:
+            config = types.GenerateContentConfig(
+                cached_content=cache_name, **self._TOOLS_CFG_KWARGS
+            )
+            contents.append(
+                types.Content(role=_ROLE_USER, parts=[types.Part(text=dynamic)])
+            )
+        else:
+            config = types.GenerateContentConfig(
+                system_instruction=head + dynamic + tail,
+                tools=TOOL_DEFINITIONS,
+                **self._TOOLS_CFG_KWARGS
+            )
+        
+        # Agregar historial (ya viene validado de get_context_for_llm: solo mensajes con texto)
+        # Solo los últimos mensajes: el trabajo no crece con la conversación completa
+        Content, Part = types.Content, types.Part
+        contents.extend([
+            Content(
+                role=_ROLE_MODEL if msg["role"] == _ROLE_MODEL else _ROLE_USER,
+                parts=[Part(text=msg["parts"][0]["text"][:10000])]  # Limitar longitud
+            )
+            for msg in history[-settings.MAX_HISTORY_MESSAGES:]
+        ])
+        
+        # Agregar mensaje actual del usuario
+        contents.append(
+            types.Content(
+                role=_ROLE_USER,
+                parts=[types.Part(text=message)]
+            )
+        )
+        return contents, config
     
     async def chat_with_tools(
         self,
@@ -558,58 +854,18 @@ SI HAY CONFLICTO con cualquier regla anterior, ESTAS INSTRUCCIONES GANAN:
             Respuesta final después de ejecutar tools si es necesario
         """
         try:
-            # Import aquí para evitar circular import
-            from app.agents.tools.definitions import TOOL_DEFINITIONS, ToolExecutor
-            
             # Validar customer
             if not customer or not customer.id:
                 logger.error("Customer inválido en chat_with_tools")
                 return "No pude identificar tu información. Por favor intenta de nuevo."
             
-            system_prompt = await self.build_system_prompt(client, customer)
+            contents, config = await self._build_tools_request(message, history, client, customer)
             tool_executor = ToolExecutor(client, customer)
             
-            # Construir contenido del chat
-            contents = []
-            
-            # Agregar historial (ya viene formateado de get_context_for_llm)
-            for msg in history:
-                try:
-                    role = msg.get("role", "user")
-                    parts = msg.get("parts", [])
-                    if parts:
-                        text = parts[0].get("text", "") if isinstance(parts[0], dict) else str(parts[0])
-                        if text and text.strip():
-                            contents.append(
-                                types.Content(
-                                    role=role,
-                                    parts=[types.Part.from_text(text=text[:10000])]  # Limitar longitud
-                                )
-                            )
-                except Exception:
-                    continue  # Saltar mensajes problemáticos
-            
-            # Agregar mensaje actual del usuario
-            contents.append(
-                types.Content(
-                    role="user",
-                    parts=[types.Part.from_text(text=message)]
-                )
-            )
-            
             # Generar respuesta con tools Y system_instruction
+            await gemini_rate_limiter.acquire(_request_tokens(contents, config))
             response = await asyncio.wait_for(
-                self.client.aio.models.generate_content(
-                    model=self.model,
-                    contents=contents,
-                    config=types.GenerateContentConfig(
-                        system_instruction=system_prompt,
-                        temperature=0.5,
-                        top_p=0.95,
-                        max_output_tokens=1024,
-                        tools=TOOL_DEFINITIONS,
-                    )
-                ),
+                self._generate_streamed(contents, config),
                 timeout=30.0
             )
             
@@ -619,177 +875,451 @@ SI HAY CONFLICTO con cualquier regla anterior, ESTAS INSTRUCCIONES GANAN:
                 contents, 
                 tool_executor
             )
+            final_response = await self._retry_empty_response(
+                final_response, contents, config, tool_executor
+            )
+            
+            return self._clean_response(final_response)
+            
+        except Exception as e:
+            logger.error(f"Error en Gemini: {e}", exc_info=True)
+            return "Lo siento, tuve un problema procesando tu mensaje. ¿Podrías intentarlo de nuevo?"
+    
+    async def _retry_empty_response(
+        self,
+        final_response: str,
+        contents: list,
+        config: types.GenerateContentConfig,
+        tool_executor
+    ) -> str:
+        """Si Gemini devolvió respuesta vacía, reintentar hasta 2 veces."""
+        retries = 0
+        while final_response.startswith(_FALLBACK_NO_CONTENT_PREFIX) and retries < 2:
+            retries += 1
+            logger.info("Reintentando Gemini (intento %d/2) por respuesta vacía...", retries)
+            await gemini_rate_limiter.acquire(_request_tokens(contents, config))
+            retry_response = await asyncio.wait_for(
+                self._generate_streamed(
+                    contents,
+                    # Subir temp ligeramente en retry
+                    config.model_copy(update={"temperature": 0.5 + (retries * 0.1)})
+                ),
+                timeout=30.0
+            )
+            final_response = await self._process_response(
+                retry_response,
+                contents,
+                tool_executor
+            )
+        return final_response
+    
+    async def chat_with_tools_stream(
+        self,
+        message: str,
+        history: list[dict],
+        client: Client,
+        customer: Customer
+    ) -> AsyncIterator[str]:
+        """
+        Igual que chat_with_tools pero entrega el texto a medida que Gemini lo genera
+        (líneas completas ya limpias), para poder enviar el primer mensaje antes.
+        Si Gemini pide una herramienta, se ejecuta por el flujo normal y se entrega
+        la respuesta final completa.
+        """
+        if not customer or not customer.id:
+            logger.error("Customer inválido en chat_with_tools_stream")
+            yield "No pude identificar tu información. Por favor intenta de nuevo."
+            return
+        
+        try:
+            contents, config = await self._build_tools_request(message, history, client, customer)
+            await gemini_rate_limiter.acquire(_request_tokens(contents, config))
+            buffer = ""
+            emitted = False
+            function_call_parts = []
+            # Con plazo: si Gemini se cuelga, TimeoutError → mismo mensaje de error que chat_with_tools
+            async with aclosing(self._stream_chunks(contents, config)) as stream:
+                async for chunk in stream:
+                    if not chunk.candidates:
+                        continue
+                    content = chunk.candidates[0].content
+                    if not content or not content.parts:
+                        continue
+                    for part in content.parts:
+                        if part.function_call:
+                            function_call_parts.append(part)
+                        elif part.text and not function_call_parts:
+                            buffer += part.text
+                    # Tras un function_call se sigue leyendo (Gemini puede mandar varias
+                    # llamadas en paralelo en chunks distintos), pero ya no se emite texto
+                    if function_call_parts:
+                        continue
+                    lines, sep, buffer = buffer.rpartition('\n')
+                    if sep and lines and not lines.isspace():
+                        emitted = True
+                        yield self._clean_markdown(lines + sep)
             
-            # Si Gemini devolvió respuesta vacía, reintentar hasta 2 veces
-            empty_msg = "Lo siento, no pude procesar tu solicitud"
-            retries = 0
-            while final_response.startswith(empty_msg) and retries < 2:
-                retries += 1
-                logger.info(f"Reintentando Gemini (intento {retries}/2) por respuesta vacía...")
-                retry_response = await asyncio.wait_for(
-                    self.client.aio.models.generate_content(
-                        model=self.model,
-                        contents=contents,
-                        config=types.GenerateContentConfig(
-                            system_instruction=system_prompt,
-                            temperature=0.5 + (retries * 0.1),  # Subir temp ligeramente en retry
-                            top_p=0.95,
-                            max_output_tokens=1024,
-                            tools=TOOL_DEFINITIONS,
+            tool_executor = ToolExecutor(client, customer)
+            if function_call_parts:
+                # Herramientas: el resto del turno sigue el flujo de _process_response
+                response = types.GenerateContentResponse(
+                    candidates=[
+                        types.Candidate(
+                            content=types.Content(role=_ROLE_MODEL, parts=function_call_parts)
                         )
-                    ),
-                    timeout=30.0
+                    ]
                 )
                 final_response = await self._process_response(
-                    retry_response,
+                    response,
                     contents,
                     tool_executor
                 )
+            elif buffer and not buffer.isspace():
+                yield self._clean_markdown(buffer)
+                return
+            elif emitted:
+                return
+            else:
+                final_response = _FALLBACK_NO_CONTENT
             
-            return self._clean_response(final_response)
-            
+            if not emitted:
+                # Respuesta vacía sin nada enviado aún: mismos reintentos que chat_with_tools
+                final_response = await self._retry_empty_response(
+                    final_response, contents, config, tool_executor
+                )
+            yield self._clean_response(final_response)
+        
         except Exception as e:
-            logger.error(f"Error en Gemini: {e}", exc_info=True)
-            return "Lo siento, tuve un problema procesando tu mensaje. ¿Podrías intentarlo de nuevo?"
+            logger.error("Error en chat_with_tools_stream: %s", e, exc_info=True)
+            yield "Lo siento, tuve un problema procesando tu mensaje. ¿Podrías intentarlo de nuevo?"
+    
+    async def _stream_chunks(self, contents, config: types.GenerateContentConfig) -> AsyncIterator:
+        """
+        generate_content_stream con un plazo total de _STREAM_TIMEOUT_SECONDS de espera a Gemini
+        (el tiempo que el consumidor tarda entre chunks, ej. enviando a WhatsApp, no cuenta).
+        Lanza asyncio.TimeoutError si Gemini se queda colgado; cierra el stream al terminar.
+        """
+        loop = asyncio.get_running_loop()
+        remaining = self._STREAM_TIMEOUT_SECONDS
+        started = loop.time()
+        stream = await asyncio.wait_for(
+            self.client.aio.models.generate_content_stream(
+                model=self.model,
+                contents=contents,
+                config=config,
+            ),
+            timeout=remaining
+        )
+        remaining -= loop.time() - started
+        chunks = aiter(stream)
+        try:
+            while True:
+                started = loop.time()
+                try:
+                    chunk = await asyncio.wait_for(anext(chunks), max(remaining, 0))
+                except StopAsyncIteration:
+                    return
+                remaining -= loop.time() - started
+                yield chunk
+        finally:
+            aclose = getattr(stream, 'aclose', None)
+            if aclose:
+                await aclose()
+    
+    async def _generate_streamed(
+        self,
+        contents: list,
+        config: types.GenerateContentConfig
+    ) -> types.GenerateContentResponse:
+        """
+        Genera con streaming y arma una única respuesta con el texto acumulado.
+        Recoge todos los function_call del stream (las llamadas en paralelo pueden
+        llegar en chunks distintos); tras el primero ya no se acumula texto.
+        El llamador pide turno al rate limiter antes (fuera del wait_for: la espera
+        por el límite no debe consumir el plazo de Gemini).
+        """
+        stream = await self.client.aio.models.generate_content_stream(
+            model=self.model,
+            contents=contents,
+            config=config,
+        )
+        text_chunks = []
+        function_call_parts = []
+        finish_reason = None
+        got_candidates = False
+        try:
+            async for chunk in stream:
+                if not chunk.candidates:
+                    continue
+                got_candidates = True
+                candidate = chunk.candidates[0]
+                finish_reason = candidate.finish_reason or finish_reason
+                if not candidate.content or not candidate.content.parts:
+                    continue
+                for part in candidate.content.parts:
+                    if part.function_call:
+                        function_call_parts.append(part)
+                    elif part.text and not function_call_parts:
+                        text_chunks.append(part.text)
+        finally:
+            aclose = getattr(stream, 'aclose', None)
+            if aclose:
+                await aclose()
+        
+        if not got_candidates:
+            return types.GenerateContentResponse(candidates=[])
+        
+        parts = []
+        if text_chunks:
+            parts.append(types.Part(text="".join(text_chunks)))
+        parts.extend(function_call_parts)
+        return types.GenerateContentResponse(
+            candidates=[
+                types.Candidate(
+                    content=types.Content(role=_ROLE_MODEL, parts=parts) if parts else None,
+                    finish_reason=finish_reason,
+                )
+            ]
+        )
     
     async def _process_response(
         self,
         response,
         contents: list,
-        tool_executor,
-        depth: int = 0
+        tool_executor
     ) -> str:
         """
         Procesa la respuesta de Gemini, ejecutando tools si es necesario.
+        Itera (en lugar de recursión) hasta obtener texto o agotar el límite de operaciones.
         """
-        if depth > 5:  # Prevenir loops infinitos
-            return "He alcanzado el límite de operaciones. Por favor intenta de nuevo."
-        
-        # Verificar si hay candidatos
-        if not response.candidates:
-            logger.warning("No candidates in response")
-            return "Lo siento, no pude procesar tu solicitud. ¿Podrías reformularla?"
-        
-        candidate = response.candidates[0]
+        # Referencias locales: se usan en cada vuelta con herramientas
+        Content = types.Content
+        from_function_call = types.Part.from_function_call
+        from_function_response = types.Part.from_function_response
         
-        # Verificar si hay contenido
-        if candidate.content and candidate.content.parts:
-            text_parts = []
-            function_call_part = None
+        for _ in range(6):  # Prevenir loops infinitos
+            # Verificar si hay candidatos
+            try:
+                c0 = response.candidates[0]
+            except (TypeError, IndexError):
+                logger.warning("No candidates in response")
+                return _FALLBACK_NO_CANDIDATES
             
-            # Recolectar todo el texto de las parts (a veces hay varias) y function calls
-            for part in candidate.content.parts:
-                if hasattr(part, 'text') and part.text and part.text.strip():
-                    text_parts.append(part.text.strip())
-                if hasattr(part, 'function_call') and part.function_call:
-                    function_call_part = part.function_call
-            
-            text_response = " ".join(text_parts) if text_parts else None
-            
-            # PRIORIZAR function calls sobre texto
-            if function_call_part:
-                fc = function_call_part
-                function_name = fc.name
-                function_args = dict(fc.args) if fc.args else {}
+            # Verificar si hay contenido
+            parts = c0.content.parts if c0.content else None
+            if parts:
+                text_parts = []
+                function_calls = []
                 
-                # Ejecutar la herramienta
-                result = await tool_executor.execute(function_name, function_args)
+                # Recolectar function calls y el texto de las parts (a veces hay varias).
+                # Como los function calls tienen prioridad, tras el primero ya no se procesa texto
+                for part in parts:
+                    fc = getattr(part, 'function_call', None)
+                    if fc:
+                        function_calls.append(fc)
+                    elif not function_calls:
+                        text = getattr(part, 'text', None)
+                        if text:
+                            text = text.strip()
+                            if text:
+                                text_parts.append(text)
                 
-                # Agregar el function call y resultado al contexto
-                contents.append(
-                    types.Content(
-                        role="model",
-                        parts=[types.Part.from_function_call(
-                            name=function_name,
-                            args=function_args
-                        )]
-                    )
-                )
-                
-                contents.append(
-                    types.Content(
-                        role="user",
-                        parts=[types.Part.from_function_response(
-                            name=function_name,
-                            response={"result": result}
-                        )]
+                # PRIORIZAR function calls sobre texto
+                if function_calls:
+                    calls = [
+                        (sys.intern(fc.name), fc.args or {})  # Sin copia: ToolExecutor acepta cualquier Mapping
+                        for fc in function_calls
+                    ]
+                    
+                    # Ejecutar las herramientas: en paralelo si Gemini pidió varias de solo
+                    # lectura en el mismo turno; en orden si alguna modifica datos
+                    if len(calls) > 1 and all(name in ToolExecutor.READ_ONLY for name, _ in calls):
+                        results = await asyncio.gather(
+                            *(tool_executor.execute(name, args) for name, args in calls)
+                        )
+                    else:
+                        results = [await tool_executor.execute(name, args) for name, args in calls]
+                    
+                    # Agregar los function calls y sus resultados al contexto
+                    contents.append(
+                        Content(
+                            role=_ROLE_MODEL,
+                            parts=[
+                                from_function_call(name=name, args=args)
+                                for name, args in calls
+                            ]
+                        )
                     )
-                )
-                
-                # Continuar la conversación con el resultado
-                from app.agents.tools.definitions import TOOL_DEFINITIONS
-                new_response = await asyncio.wait_for(
-                    self.client.aio.models.generate_content(
-                        model=self.model,
-                        contents=contents,
-                        config=types.GenerateContentConfig(
-                            temperature=0.5,
-                            max_output_tokens=1024,
-                            tools=TOOL_DEFINITIONS,
+                    
+                    contents.append(
+                        Content(
+                            role=_ROLE_USER,
+                            parts=[
+                                from_function_response(
+                                    name=name,
+                                    response={"result": result}
+                                )
+                                for (name, _), result in zip(calls, results)
+                            ]
                         )
-                    ),
-                    timeout=30.0
-                )
+                    )
+                    
+                    # Continuar la conversación con el resultado
+                    await gemini_rate_limiter.acquire(_request_tokens(contents, self._FOLLOWUP_CONFIG))
+                    response = await asyncio.wait_for(
+                        self._generate_streamed(contents, self._FOLLOWUP_CONFIG),
+                        timeout=30.0
+                    )
+                    continue
                 
-                # Procesar recursivamente
-                return await self._process_response(
-                    new_response, 
-                    contents, 
-                    tool_executor,
-                    depth + 1
-                )
+                # Si solo hay texto (sin function call), retornarlo
+                if text_parts:
+                    return " ".join(text_parts)
             
-            # Si solo hay texto (sin function call), retornarlo
-            if text_response:
-                return text_response
-        
-        # Si no hay partes, intentar extraer texto directamente del response
-        if hasattr(response, 'text') and response.text and response.text.strip():
-            return response.text.strip()
-        
-        # Debug logging cuando no hay contenido
-        if response.candidates:
-            c0 = response.candidates[0]
+            # Si no hay partes útiles, buscar texto en cualquier candidato
+            fallback_text = next(self._iter_text_parts(response), None)
+            if fallback_text:
+                return fallback_text
+            
+            # Debug logging cuando no hay contenido
             if getattr(c0, 'finish_reason', None):
-                logger.debug(f"Gemini finish_reason: {c0.finish_reason}")
+                logger.debug("Gemini finish_reason: %s", c0.finish_reason)
                 if c0.content:
-                    logger.debug(f"Content parts count: {len(c0.content.parts) if c0.content.parts else 0}")
-                    for i, p in enumerate(c0.content.parts or []):
-                        logger.debug(f"  Part {i}: text={getattr(p, 'text', None)[:50] if getattr(p, 'text', None) else None}, function_call={getattr(p, 'function_call', None)}")
+                    logger.debug("Content parts count: %d", len(parts) if parts else 0)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        for i, p in enumerate(parts or []):
+                            text = getattr(p, 'text', None)
+                            logger.debug(
+                                "  Part %d: text=%s, function_call=%s",
+                                i, text[:50] if text else None, getattr(p, 'function_call', None)
+                            )
                 else:
                     logger.debug("Response candidate has no content object")
+            
+            logger.warning("No content found in response")
+            return _FALLBACK_NO_CONTENT
         
-        logger.warning("No content found in response")
-        return "Lo siento, no pude procesar tu solicitud. ¿Podrías intentarlo de nuevo?"
+        return "He alcanzado el límite de operaciones. Por favor intenta de nuevo."
+    
+    @staticmethod
+    def _iter_text_parts(response):
+        """Genera el texto no vacío (sin espacios extremos) de cada part de cada candidato."""
+        for candidate in response.candidates or ():
+            content = candidate.content
+            for part in (content.parts or ()) if content else ():
+                text = getattr(part, 'text', None)
+                if text:
+                    text = text.strip()
+                    if text:
+                        yield text
     
     async def chat_simple(
         self,
         message: str,
-        system_prompt: str
+        system_prompt: str,
+        context: str = "",
+        context_key: str | None = None
     ) -> str:
         """
         Chat simple sin historial ni tools.
+        system_prompt debe ser estable (se cachea en Gemini); lo que cambia en cada
+        mensaje (cliente, fecha y hora) va en context y viaja como contenido.
+        context_key identifica a context en el caché de respuestas (ej. sin los minutos
+        de la hora, para que la clave no cambie cada minuto); por defecto, context.
+        Llamadas idénticas concurrentes (ej. reintentos del webhook) comparten una sola petición a Gemini.
         """
+        if context_key is None:
+            context_key = context
+        return await self._inflight.run(
+            (hash(system_prompt), hash(context_key), hash(message)),
+            lambda: self._chat_simple(message, system_prompt, context, context_key),
+        )
+    
+    async def _chat_simple(self, message: str, system_prompt: str, context: str, context_key: str) -> str:
+        """Llamada real a Gemini de chat_simple (con caché de respuestas en Redis)."""
         try:
-            full_prompt = f"{system_prompt}\n\nUsuario: {message}"
+            cache_key = chat_response_cache.make_key(
+                self.model, system_prompt, context_key, normalize_text(message)
+            )
+            cached = await chat_response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            
+            contents, config = await self._simple_request(message, system_prompt, context)
+            await gemini_rate_limiter.acquire(estimate_tokens(message, context, system_prompt))
             
             response = await asyncio.wait_for(
                 self.client.aio.models.generate_content(
                     model=self.model,
-                    contents=full_prompt,
-                    config=types.GenerateContentConfig(
-                        temperature=0.5,
-                        max_output_tokens=1024,
-                    )
+                    contents=contents,
+                    config=config
                 ),
                 timeout=30.0
             )
             
-            return self._clean_response(response.text)
+            result = self._clean_response(response.text)
+            if result:
+                await chat_response_cache.set(cache_key, result)
+            return result
             
         except Exception as e:
-            logger.error(f"Error en chat_simple: {e}", exc_info=True)
-            return "Error procesando el mensaje."
+            logger.error("Error en chat_simple: %s", e, exc_info=True)
+            return _FALLBACK_ERROR
+    
+    async def chat_simple_stream(
+        self,
+        message: str,
+        system_prompt: str,
+        context: str = ""
+    ) -> AsyncIterator[str]:
+        """
+        Igual que chat_simple pero entrega el texto a medida que Gemini lo genera.
+        Emite líneas completas ya limpias (negritas y encabezados no se parten entre chunks).
+        """
+        buffer = ""
+        emitted = False
+        try:
+            contents, config = await self._simple_request(message, system_prompt, context)
+            await gemini_rate_limiter.acquire(estimate_tokens(message, context, system_prompt))
+            # Con plazo: si Gemini se cuelga, TimeoutError → mismo mensaje de error que chat_simple
+            async with aclosing(self._stream_chunks(contents, config)) as stream:
+                async for chunk in stream:
+                    if not chunk.text:
+                        continue
+                    buffer += chunk.text
+                    lines, sep, buffer = buffer.rpartition('\n')
+                    if sep and lines and not lines.isspace():
+                        emitted = True
+                        yield self._clean_markdown(lines + sep)
+            if buffer and not buffer.isspace():
+                yield self._clean_markdown(buffer)
+            elif not emitted:
+                # Respuesta vacía (bloqueo o sin candidatos): no mandar un mensaje en blanco
+                logger.warning("Gemini devolvió respuesta vacía en chat_simple_stream")
+                yield _FALLBACK_NO_CONTENT
+        except Exception as e:
+            logger.error("Error en chat_simple_stream: %s", e, exc_info=True)
+            yield _FALLBACK_ERROR
+    
+    async def _simple_request(
+        self, message: str, system_prompt: str, context: str
+    ) -> tuple[str | list, types.GenerateContentConfig]:
+        """Arma contents y config de chat_simple / chat_simple_stream."""
+        # System prompt desde el caché explícito de Gemini; si no se pudo cachear,
+        # va como system_instruction (prefijo estable para el caché implícito)
+        cache_name = await self._get_prompt_cache(system_prompt)
+        if cache_name:
+            config = self._SIMPLE_CONFIG.model_copy(update={"cached_content": cache_name})
+        else:
+            config = self._SIMPLE_CONFIG.model_copy(update={"system_instruction": system_prompt})
+        if not context:
+            return message, config
+        # Igual que en _build_tools_request: la parte dinámica va antes del mensaje
+        contents = [
+            types.Content(role=_ROLE_USER, parts=[types.Part(text=context)]),
+            types.Content(role=_ROLE_USER, parts=[types.Part(text=message)]),
+        ]
+        return contents, config
 
     async def answer_from_context(self, context: str, question: str) -> str:
         """
@@ -812,6 +1342,7 @@ SI HAY CONFLICTO con cualquier regla anterior, ESTAS INSTRUCCIONES GANAN:
                 "Si necesitas sumar precios, usa SOLO los valores exactos del contexto."
             )
             user_content = f"Contexto (catálogo del negocio):\n\n{context[:300000]}\n\n---\nPregunta del cliente: {question}"
+            await gemini_rate_limiter.acquire(estimate_tokens(user_content, system))
             response = await asyncio.wait_for(
                 self.client.aio.models.generate_content(
                     model=self.model,
@@ -848,6 +1379,7 @@ SI HAY CONFLICTO con cualquier regla anterior, ESTAS INSTRUCCIONES GANAN:
             logger.warning("PDF demasiado grande para extracción con Gemini (>15MB)")
             return None
         try:
+            await gemini_rate_limiter.acquire(estimate_media_tokens("application/pdf", len(pdf_bytes)))
             response = await asyncio.wait_for(
                 self.client.aio.models.generate_content(
                     model=self.model,
@@ -895,29 +1427,46 @@ SI HAY CONFLICTO con cualquier regla anterior, ESTAS INSTRUCCIONES GANAN:
         if customer:
             return await self.chat_with_tools(message, history, client, customer)
         else:
-            # Fallback sin tools
+            # Fallback sin tools: inicio y final estáticos cacheados, el resto como contenido
+            head, tail = await self._get_static_sections(client)
+            now = datetime.now()
             return await self.chat_simple(
-                message, 
-                await self.build_system_prompt(client, customer)
+                message,
+                head + tail,
+                context=self._build_dynamic_section(customer, now),
+                context_key=self._dynamic_cache_key(customer, now)
             )
     
+    async def chat_stream(
+        self,
+        message: str,
+        history: list[dict],
+        client: Client,
+        customer: Customer | None = None
+    ) -> AsyncIterator[str]:
+        """Igual que chat pero en streaming (chat_with_tools_stream si hay customer)."""
+        if customer:
+            async for chunk in self.chat_with_tools_stream(message, history, client, customer):
+                yield chunk
+        else:
+            head, tail = await self._get_static_sections(client)
+            context = self._build_dynamic_section(customer, datetime.now())
+            async for chunk in self.chat_simple_stream(message, head + tail, context):
+                yield chunk
+    
     def _clean_response(self, text: str) -> str:
         """Limpia la respuesta para WhatsApp."""
         if not text:
             return ""
-        
-        text = text.replace("**", "*")
-        text = text.replace("```", "")
-        
-        lines = text.split('\n')
-        cleaned_lines = []
-        for line in lines:
-            if line.startswith('#'):
-                line = '*' + line.lstrip('#').strip() + '*'
-            cleaned_lines.append(line)
-        text = '\n'.join(cleaned_lines)
-        
-        return text.strip()
+        return self._clean_markdown(text).strip()
+    
+    @staticmethod
+    def _clean_markdown(text: str) -> str:
+        """Convierte markdown a formato WhatsApp sin recortar espacios (sirve para fragmentos)."""
+        # "**" → "*" (negrita de WhatsApp) y quitar bloques de código
+        text = _MARKDOWN_RE.sub(r'\1', text)
+        # Encabezados markdown → negrita
+        return _HEADER_RE.sub(r'*\1*', text)
 
 
 # Instancia global
@@ -0,0 +1,56 @@
+"""
+Deduplicación de llamadas concurrentes (single-flight).
+Si llegan varias peticiones iguales a la vez (ej. el webhook reentregado para el
+mismo mensaje o media_id), solo la primera ejecuta el trabajo y las demás esperan
+su resultado en vez de repetir la llamada a Gemini / WhatsApp.
+"""
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import TypeVar
+
+T = TypeVar("T")
+
+
+class InflightCoalescer:
+    """
+    Ejecuta run() una sola vez por key mientras haya una llamada en curso.
+    - Si la llamada falla, los que esperaban reciben la misma excepción.
+    - Si la tarea que la ejecutaba se cancela, los que esperaban (y no fueron
+      cancelados) reintentan: uno de ellos pasa a ejecutarla.
+    Con más de max_entries claves en curso se ejecuta sin deduplicar.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, run: Callable[[], Awaitable[T]]) -> T:
+        while (inflight := self._inflight.get(key)) is not None:
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Cancelaron a quien ejecutaba la llamada, no a nosotros: reintentar
+                if inflight.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+        if len(self._inflight) >= self.max_entries:
+            return await run()
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await run()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Marcar como leída: sin nadie esperando, asyncio avisaría
+            # "Future exception was never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
@@ -0,0 +1,149 @@
+"""
+Caché de respuestas de Gemini en Redis.
+Evita repetir la llamada al modelo cuando llega la misma consulta (reintentos del
+webhook, mensajes reenviados, preguntas repetidas con distinto formato).
+"""
+import hashlib
+import io
+import logging
+import re
+
+from app.core.config import settings
+from app.core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normaliza un texto para usarlo como clave de caché:
+    minúsculas, espacios colapsados y sin signos de puntuación al inicio/final.
+    "  ¿Cuál es el horario? " y "cuál es el  horario" dan la misma clave.
+    """
+    return _WHITESPACE_RE.sub(' ', text).casefold().strip(' ¿?¡!.')
+
+
+class ResponseCache:
+    """
+    Caché de respuestas en Redis con TTL, por espacio de nombres.
+    Si Redis no está disponible, funciona como si no hubiera caché (nunca lanza).
+    """
+
+    def __init__(self, namespace: str, ttl_seconds: int):
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+
+    def make_key(self, *parts: str | bytes) -> str:
+        """Clave sha256 de las partes (textos o bytes crudos, ej. un audio)."""
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            # Prefijo de longitud: ("ab", "c") y ("a", "bc") no colisionan
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        return f"{self.namespace}:{digest.hexdigest()}"
+
+    async def get(self, key: str) -> str | None:
+        """Devuelve la respuesta cacheada o None."""
+        try:
+            return await get_redis().get(key)
+        except Exception as e:
+            logger.debug("Caché %s no disponible: %s", self.namespace, e)
+            return None
+
+    async def set(self, key: str, value: str):
+        """Guarda una respuesta con el TTL del caché."""
+        try:
+            await get_redis().set(key, value, ex=self.ttl_seconds)
+        except Exception as e:
+            logger.debug("No se pudo guardar en caché %s: %s", self.namespace, e)
+
+
+def image_dhash(image_bytes: bytes) -> int | None:
+    """
+    Hash perceptual (dHash de 64 bits) de una imagen: la misma foto re-codificada,
+    reenviada o redimensionada da el mismo hash o uno a pocos bits de distancia.
+    Síncrono (decodifica la imagen): llamar con asyncio.to_thread.
+    Retorna None si Pillow no está instalado o la imagen no se puede leer.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            # En JPEG decodifica directo a baja resolución (mucho más rápido)
+            img.draft("L", (64, 64))
+            px = img.convert("L").resize((9, 8), Image.Resampling.BILINEAR).tobytes()
+    except Exception as e:
+        logger.debug("No se pudo calcular dHash de la imagen: %s", e)
+        return None
+    bits = 0
+    for row in range(0, 72, 9):
+        for col in range(row, row + 8):
+            bits = (bits << 1) | (px[col] > px[col + 1])
+    return bits
+
+
+class ImageHashCache:
+    """
+    Caché de análisis de imágenes por hash perceptual, por cliente.
+    Busca primero el hash exacto y luego, entre los últimos hashes del cliente,
+    uno a distancia de Hamming <= max_distance con el mismo prompt.
+    """
+
+    def __init__(self, namespace: str, ttl_seconds: int, recent: int = 50, max_distance: int = 5):
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.recent = recent
+        self.max_distance = max_distance
+
+    def _key(self, client_id: int, phash: int, prompt_hash: str) -> str:
+        return f"{self.namespace}:{client_id}:{phash:016x}:{prompt_hash}"
+
+    async def get(self, client_id: int, phash: int, prompt: str) -> str | None:
+        """Devuelve el análisis de una imagen igual o casi igual, o None."""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+        try:
+            redis = get_redis()
+            cached = await redis.get(self._key(client_id, phash, prompt_hash))
+            if cached is not None:
+                return cached
+            # Vecinos: últimos hashes vistos para este cliente ("phash_hex:prompt_hash")
+            for entry in await redis.lrange(f"{self.namespace}:{client_id}:recent", 0, self.recent - 1):
+                other_hex, _, other_prompt = entry.partition(':')
+                if other_prompt != prompt_hash:
+                    continue
+                other = int(other_hex, 16)
+                if other != phash and (other ^ phash).bit_count() <= self.max_distance:
+                    cached = await redis.get(self._key(client_id, other, prompt_hash))
+                    if cached is not None:
+                        return cached
+        except Exception as e:
+            logger.debug("Caché %s no disponible: %s", self.namespace, e)
+        return None
+
+    async def set(self, client_id: int, phash: int, prompt: str, value: str):
+        """Guarda el análisis y registra el hash entre los recientes del cliente."""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+        recent_key = f"{self.namespace}:{client_id}:recent"
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.set(self._key(client_id, phash, prompt_hash), value, ex=self.ttl_seconds)
+                pipe.lpush(recent_key, f"{phash:016x}:{prompt_hash}")
+                pipe.ltrim(recent_key, 0, self.recent - 1)
+                pipe.expire(recent_key, self.ttl_seconds)
+                await pipe.execute()
+        except Exception as e:
+            logger.debug("No se pudo guardar en caché %s: %s", self.namespace, e)
+
+
+# Instancias globales
+chat_response_cache = ResponseCache("llm:chat", settings.LLM_CACHE_TTL_SECONDS)
+image_response_cache = ResponseCache("llm:image", settings.LLM_CACHE_TTL_SECONDS)
+# Transcripciones/análisis de baja temperatura: mismos bytes → mismo resultado, se guardan 24h
+media_response_cache = ResponseCache("llm:media", 86400)
+vision_hash_cache = ImageHashCache("llm:vision", settings.LLM_CACHE_TTL_SECONDS)
@@ -1,17 +1,123 @@
 """
 Servicio para procesamiento de multimedia (audio, documentos).
 """
+import asyncio
+import io
 import logging
-import base64
 import httpx
+import re
+import time
+from itertools import islice
 from google import genai
 from google.genai import types
 
 from app.core.config import settings
+from app.services.inflight import InflightCoalescer
+from app.services.llm_cache import (
+    image_dhash,
+    image_response_cache,
+    media_response_cache,
+    normalize_text,
+    vision_hash_cache,
+)
+from app.services.ratelimit import estimate_media_tokens, estimate_tokens, gemini_rate_limiter
 from app.services.whatsapp import whatsapp_service
 
 logger = logging.getLogger(__name__)
 
+_WORD_RE = re.compile(r'\w{3,}')
+
+# Productos del catálogo en el prompt: los más parecidos al texto del usuario, o los primeros
+_CATALOG_TOP_MATCHES = 5
+_CATALOG_MAX_PRODUCTS = 20
+
+
+# Imágenes para Gemini Vision: lado mayor máximo y calidad WebP al re-codificar
+_VISION_MAX_SIDE = 1024
+_VISION_WEBP_QUALITY = 80
+
+
+def _prepare_vision_image(image_bytes: bytes) -> tuple[bytes, str]:
+    """
+    Reduce la imagen a _VISION_MAX_SIDE px de lado mayor y la re-codifica a WebP
+    (menos bytes que subir y menos tokens de visión, sin perder calidad útil).
+    Síncrono (decodifica la imagen): llamar con asyncio.to_thread.
+    Si Pillow no está instalado o la imagen no se puede leer, devuelve la original.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return image_bytes, "image/jpeg"
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.draft("RGB", (_VISION_MAX_SIDE, _VISION_MAX_SIDE))
+            img = img.convert("RGB")
+            img.thumbnail((_VISION_MAX_SIDE, _VISION_MAX_SIDE))
+            buf = io.BytesIO()
+            img.save(buf, "WEBP", quality=_VISION_WEBP_QUALITY)
+    except Exception as e:
+        logger.debug("No se pudo re-codificar la imagen: %s", e)
+        return image_bytes, "image/jpeg"
+    webp = buf.getvalue()
+    if len(webp) >= len(image_bytes):
+        return image_bytes, "image/jpeg"
+    return webp, "image/webp"
+
+
+def _terms(text: str) -> set[str]:
+    """Palabras (3+ letras, normalizadas) de un texto, para comparar caption y catálogo."""
+    return set(_WORD_RE.findall(normalize_text(text)))
+
+
+def _select_products(products: list[dict], caption_terms: set[str] | None) -> list[dict]:
+    """
+    Si el caption comparte palabras con productos del catálogo, solo los
+    _CATALOG_TOP_MATCHES con más coincidencias; si no, los primeros _CATALOG_MAX_PRODUCTS.
+    """
+    if caption_terms:
+        scored = [(len(caption_terms & _terms(prod['name'])), i) for i, prod in enumerate(products)]
+        best = sorted((s for s in scored if s[0] > 0), key=lambda s: -s[0])[:_CATALOG_TOP_MATCHES]
+        if best:
+            return [products[i] for _, i in best]
+    return products[:_CATALOG_MAX_PRODUCTS]
+
+
+def _render_business_context(business_context: dict, caption_terms: set[str] | None = None) -> str:
+    """Texto con catálogo, servicios y profesionales del negocio para el análisis de imágenes."""
+    context_parts = []
+    
+    # Catálogo de productos (los relevantes al caption, o máximo 20)
+    if 'catalog' in business_context:
+        categories = business_context['catalog'].get('categories', [])
+        products = [prod for cat in categories for prod in cat.get('products', [])]
+        productos = "\n".join(
+            f"- {prod['name']}: ${prod.get('price', 'N/A')}"
+            for prod in _select_products(products, caption_terms)
+        )
+        if productos:
+            context_parts.append("CATÁLOGO DE PRODUCTOS:\n" + productos)
+    
+    # Servicios (solo los reales, máximo 10)
+    if 'services' in business_context:
+        servicios = "\n".join(islice(
+            (f"- {s['name']}: ${s['price']}"
+             for s in business_context['services'] if s.get('price', 0) > 0),
+            10
+        ))
+        if servicios:
+            context_parts.append("SERVICIOS DISPONIBLES:\n" + servicios)
+    
+    # Profesionales
+    if 'professionals' in business_context:
+        profs = "\n".join(
+            f"- {p['name']} ({p.get('specialty', 'General')})"
+            for p in business_context['professionals']
+        )
+        if profs:
+            context_parts.append("PROFESIONALES:\n" + profs)
+    
+    return "\n\n".join(context_parts) if context_parts else "No hay catálogo específico configurado."
+
 
 class MediaService:
     """
@@ -20,11 +126,50 @@ class MediaService:
     - Procesamiento de documentos
     """
     
+    # Caché del texto de contexto del negocio (cambia poco: catálogo/servicios/profesionales)
+    _CONTEXT_CACHE_TTL_SECONDS = 300
+    _CONTEXT_CACHE_MAX_ENTRIES = 256
+    
     def __init__(self):
         self.client = genai.Client(api_key=settings.GOOGLE_API_KEY)
         self.model = settings.GEMINI_MODEL
+        # (operación, media_id) -> resultado en curso
+        self._inflight = InflightCoalescer()
+        # client_id -> (válido hasta [monotonic], texto de contexto)
+        self._context_cache: dict[int, tuple[float, str]] = {}
+    
+    def _business_context_text(self, business_context: dict, client_id: int | None, caption: str = "") -> str:
+        """
+        Contexto del negocio ya renderizado, cacheado por cliente durante
+        _CONTEXT_CACHE_TTL_SECONDS (los cambios de catálogo se ven en ≤5 min).
+        Con caption, el catálogo se filtra a los productos que coinciden (sin caché).
+        """
+        caption_terms = _terms(caption) if caption else None
+        if caption_terms:
+            return _render_business_context(business_context, caption_terms)
+        if client_id is None:
+            return _render_business_context(business_context)
+        
+        now = time.monotonic()
+        entry = self._context_cache.get(client_id)
+        if entry and entry[0] > now:
+            return entry[1]
+        
+        text = _render_business_context(business_context)
+        self._context_cache.pop(client_id, None)
+        self._context_cache[client_id] = (now + self._CONTEXT_CACHE_TTL_SECONDS, text)
+        while len(self._context_cache) > self._CONTEXT_CACHE_MAX_ENTRIES:
+            self._context_cache.pop(next(iter(self._context_cache)))
+        return text
     
     async def download_media(self, media_id: str, *, access_token: str, api_version: str) -> bytes | None:
+        """Descarga un media de WhatsApp (descargas concurrentes del mismo media_id se comparten)."""
+        return await self._inflight.run(
+            ("download", media_id),
+            lambda: self._download_media(media_id, access_token=access_token, api_version=api_version),
+        )
+    
+    async def _download_media(self, media_id: str, *, access_token: str, api_version: str) -> bytes | None:
        
         try:
             # Primero obtener la URL del media
@@ -53,6 +198,13 @@ class MediaService:
         Returns:
             Texto transcrito
         """
+        return await self._inflight.run(
+            ("audio", media_id),
+            lambda: self._transcribe_audio(media_id, access_token=access_token, api_version=api_version),
+        )
+    
+    async def _transcribe_audio(self, media_id: str, *, access_token: str, api_version: str) -> str:
+        """Transcripción real (ver transcribe_audio)."""
         try:
             # Descargar el audio
             audio_content = await self.download_media(media_id, access_token=access_token, api_version=api_version)
@@ -60,10 +212,14 @@ class MediaService:
             if not audio_content:
                 return "[No se pudo descargar el audio]"
             
-            # Convertir a base64
-            audio_base64 = base64.b64encode(audio_content).decode('utf-8')
+            # Mismo audio (reintento del webhook, nota de voz reenviada) → transcripción cacheada
+            cache_key = media_response_cache.make_key(self.model, "audio/ogg", audio_content)
+            cached = await media_response_cache.get(cache_key)
+            if cached is not None:
+                return cached
             
             # Usar Gemini para transcribir
+            await gemini_rate_limiter.acquire(estimate_media_tokens("audio/ogg", len(audio_content)))
             response = await self.client.aio.models.generate_content(
                 model=self.model,
                 contents=[
@@ -93,6 +249,7 @@ class MediaService:
             if not transcription:
                 return "[No se pudo transcribir el audio. ¿Podrías repetirlo o escribir tu mensaje?]"
             logger.debug("Audio transcrito")
+            await media_response_cache.set(cache_key, transcription)
             return transcription
             
         except Exception as e:
@@ -125,7 +282,14 @@ class MediaService:
             else:
                 return f"[Documento recibido: {filename}]"
             
+            # Mismo PDF → análisis cacheado (sin volver a subir los bytes a Gemini)
+            cache_key = media_response_cache.make_key(self.model, mime_type, content)
+            cached = await media_response_cache.get(cache_key)
+            if cached is not None:
+                return f"[Contenido del documento {filename}]:\n{cached}"
+            
             # Usar Gemini para procesar PDF
+            await gemini_rate_limiter.acquire(estimate_media_tokens(mime_type, len(content)))
             response = await self.client.aio.models.generate_content(
                 model=self.model,
                 contents=[
@@ -153,13 +317,15 @@ class MediaService:
                 return f"[No se pudo analizar el documento: {filename}]"
             analysis = response.text.strip()
             logger.debug(f"Documento procesado: {filename}")
+            if analysis:
+                await media_response_cache.set(cache_key, analysis)
             return f"[Contenido del documento {filename}]:\n{analysis}"
             
         except Exception as e:
             logger.error(f"Error procesando documento: {e}")
             return f"[Error al procesar el documento: {filename}]"
     
-    async def analyze_image(self, media_id: str, caption: str, business_context: dict, *, access_token: str, api_version: str) -> str:
+    async def analyze_image(self, media_id: str, caption: str, business_context: dict, *, access_token: str, api_version: str, client_id: int | None = None) -> str:
         """
         Analiza una imagen enviada por el usuario usando Gemini Vision.
         Incluye contexto del negocio para dar respuestas inteligentes.
@@ -169,6 +335,7 @@ class MediaService:
             caption: Texto que acompaña la imagen (si hay)
             business_context: Configuración del negocio (catalog, services, professionals)
             access_token: Token de acceso de Meta del cliente
+            client_id: ID del cliente; si se pasa, el texto de contexto se cachea por cliente
             
         Returns:
             Descripción/análisis de la imagen con contexto del negocio
@@ -180,46 +347,17 @@ class MediaService:
             if not image_content:
                 return f"[No se pudo descargar la imagen]{' - ' + caption if caption else ''}"
             
-            # Construir contexto del negocio para el análisis
-            context_parts = []
-            
-            # Catálogo de productos
-            if 'catalog' in business_context:
-                categories = business_context['catalog'].get('categories', [])
-                if categories:
-                    productos = []
-                    for cat in categories:
-                        for prod in cat.get('products', []):
-                            precio = prod.get('price', 'N/A')
-                            productos.append(f"- {prod['name']}: ${precio}")
-                    if productos:
-                        context_parts.append(f"CATÁLOGO DE PRODUCTOS:\n" + "\n".join(productos[:20]))  # Limitar a 20
-            
-            # Servicios
-            if 'services' in business_context:
-                servicios = []
-                for s in business_context['services']:
-                    if s.get('price', 0) > 0:  # Solo servicios reales
-                        servicios.append(f"- {s['name']}: ${s['price']}")
-                if servicios:
-                    context_parts.append(f"SERVICIOS DISPONIBLES:\n" + "\n".join(servicios[:10]))
-            
-            # Profesionales
-            if 'professionals' in business_context:
-                profs = []
-                for p in business_context['professionals']:
-                    profs.append(f"- {p['name']} ({p.get('specialty', 'General')})")
-                if profs:
-                    context_parts.append(f"PROFESIONALES:\n" + "\n".join(profs))
-            
             # Nombre del negocio
             business_name = business_context.get('business_name', 'el negocio')
             business_type = business_context.get('business_type', 'general')
             
-            context_text = "\n\n".join(context_parts) if context_parts else "No hay catálogo específico configurado."
-            
             # Prompt para Gemini Vision
-            user_caption = f'\n\nEl usuario dice: "{caption}"' if caption and caption != "[Imagen recibida]" else ""
+            has_caption = bool(caption) and caption != "[Imagen recibida]"
+            user_caption = f'\n\nEl usuario dice: "{caption}"' if has_caption else ""
+            
+            context_text = self._business_context_text(
+                business_context, client_id, caption if has_caption else ""
+            )
             
             prompt = f"""Eres el asistente virtual de {business_name} (tipo: {business_type}).
 
@@ -238,7 +376,23 @@ INSTRUCCIONES:
 
 Responde en español, de forma concisa y útil para WhatsApp (usa *negritas* y emojis moderadamente)."""
 
-            # Llamar a Gemini con la imagen
+            # Misma imagen (o re-codificada/reenviada) + mismo texto + mismo negocio → misma respuesta.
+            # Con hash perceptual si hay client_id y Pillow; si no, por bytes exactos
+            normalized_prompt = f"{self.model}\n{normalize_text(prompt)}"
+            phash = await asyncio.to_thread(image_dhash, image_content) if client_id is not None else None
+            if phash is not None:
+                cached = await vision_hash_cache.get(client_id, phash, normalized_prompt)
+            else:
+                cache_key = image_response_cache.make_key(image_content, normalized_prompt)
+                cached = await image_response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+            # Llamar a Gemini con la imagen (reducida a 1024px en WebP)
+            vision_bytes, vision_mime = await asyncio.to_thread(_prepare_vision_image, image_content)
+            await gemini_rate_limiter.acquire(
+                estimate_tokens(prompt) + estimate_media_tokens(vision_mime, len(vision_bytes))
+            )
             response = await self.client.aio.models.generate_content(
                 model=self.model,
                 contents=[
@@ -246,8 +400,8 @@ Responde en español, de forma concisa y útil para WhatsApp (usa *negritas* y e
                         role="user",
                         parts=[
                             types.Part.from_bytes(
-                                data=image_content,
-                                mime_type="image/jpeg"  # WhatsApp normalmente usa JPEG
+                                data=vision_bytes,
+                                mime_type=vision_mime
                             ),
                             types.Part.from_text(text=prompt)
                         ]
@@ -265,6 +419,11 @@ Responde en español, de forma concisa y útil para WhatsApp (usa *negritas* y e
             
             analysis = response.text.strip()
             logger.debug("Imagen analizada correctamente")
+            if analysis:
+                if phash is not None:
+                    await vision_hash_cache.set(client_id, phash, normalized_prompt, analysis)
+                else:
+                    await image_response_cache.set(cache_key, analysis)
             return analysis
             
         except Exception as e:
@@ -0,0 +1,83 @@
+"""
+Limitador de tasa (token bucket) del lado del cliente para llamadas a Gemini.
+Con ráfagas de mensajes/audios/imágenes las peticiones esperan turno localmente
+en vez de chocar con el límite RPM/TPM del proyecto (429 + reintentos).
+"""
+import asyncio
+import time
+
+from app.core.config import settings
+
+# Heurística de Gemini: ~4 caracteres por token
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(*texts: str | None) -> int:
+    """Tokens de entrada aproximados de uno o varios textos."""
+    return sum(len(t) for t in texts if t) // CHARS_PER_TOKEN
+
+
+# Costes de media según la documentación de Gemini, estimados desde el tamaño en bytes
+AUDIO_TOKENS_PER_SECOND = 32
+AUDIO_BYTES_PER_SECOND = 2_000  # Notas de voz de WhatsApp (Opus ~16 kbps)
+PDF_TOKENS_PER_PAGE = 258
+PDF_BYTES_PER_PAGE = 50_000  # Sin abrir el PDF: ~50 KB por página
+IMAGE_TOKENS = 4 * 258  # Imagen de hasta 1024px: ~4 tiles de 258 tokens
+
+
+def estimate_media_tokens(mime_type: str, size: int) -> int:
+    """Tokens de entrada aproximados de un archivo de audio, PDF o imagen de size bytes."""
+    if mime_type.startswith("audio/"):
+        return max(1, size // AUDIO_BYTES_PER_SECOND) * AUDIO_TOKENS_PER_SECOND
+    if mime_type.startswith("image/"):
+        return IMAGE_TOKENS
+    return max(1, size // PDF_BYTES_PER_PAGE) * PDF_TOKENS_PER_PAGE
+
+
+class AsyncTokenBucket:
+    """
+    Token bucket asíncrono: se recarga a rate_per_min tokens por minuto hasta capacity.
+    acquire() espera (sin bloquear el event loop) hasta que haya tokens; los que esperan
+    se atienden en orden de llegada.
+    """
+
+    def __init__(self, rate_per_min: float, capacity: float | None = None):
+        self.rate_per_sec = rate_per_min / 60.0
+        self.capacity = capacity or rate_per_min
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_sec)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1):
+        """Consume amount tokens, esperando lo necesario. Nunca pide más que capacity."""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self._tokens < amount:
+                await asyncio.sleep((amount - self._tokens) / self.rate_per_sec)
+                self._refill()
+            self._tokens -= amount
+
+
+class GeminiRateLimiter:
+    """Buckets de peticiones (RPM) y tokens (TPM); un límite en 0 lo desactiva."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self._rpm = AsyncTokenBucket(rpm) if rpm > 0 else None
+        self._tpm = AsyncTokenBucket(tpm) if tpm > 0 else None
+
+    async def acquire(self, estimated_tokens: int = 0):
+        """Esperar turno antes de una llamada a Gemini."""
+        if self._rpm is not None:
+            await self._rpm.acquire(1)
+        if self._tpm is not None and estimated_tokens > 0:
+            await self._tpm.acquire(estimated_tokens)
+
+
+# Instancia global (todas las llamadas usan settings.GEMINI_MODEL)
+gemini_rate_limiter = GeminiRateLimiter(settings.GEMINI_RPM, settings.GEMINI_TPM)
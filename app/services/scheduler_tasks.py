@@ -2,10 +2,14 @@
 Funciones reutilizables para tareas programadas (recordatorios, confirmaciones).
 Los recordatorios se envían solo por correo para evitar spam en WhatsApp.
 """
-from datetime import datetime, timedelta
-from sqlalchemy import select, and_
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import groupby
+from zoneinfo import ZoneInfo
+from sqlalchemy import Row, select, and_
+import asyncio
 import logging
-import pytz
+import re
 
 from app.core.database import AsyncSessionLocal
 from app.models.tables import Client, Customer, Appointment
@@ -13,6 +17,169 @@ from app.services.email_service import email_service
 
 logger = logging.getLogger(__name__)
 
+# Correos SMTP enviados en paralelo por tarea (cada envío ocupa un hilo de asyncio.to_thread)
+_EMAIL_CONCURRENCY = 10
+
+# Citas leídas por lote con un cursor del servidor (memoria acotada en ventanas grandes)
+_APPOINTMENTS_BATCH_SIZE = 200
+
+# customers.data->>'email': solo se consultan citas de clientes con correo
+_CUSTOMER_EMAIL = Customer.data['email'].as_string()
+
+# Columnas que usan los correos (sin hidratar entidades ORM ni el JSON completo del cliente)
+_REMINDER_COLUMNS = (
+    Appointment.client_id,
+    Appointment.start_time,
+    Appointment.notes,
+    Customer.full_name,
+    Customer.phone_number,
+    _CUSTOMER_EMAIL.label("email"),
+    Client.business_name,
+    Client.tools_config,
+)
+
+
+@lru_cache(maxsize=64)
+def _tz(name: str) -> ZoneInfo:
+    """Zona horaria por nombre, cacheada (pocas zonas, muchas citas)."""
+    return ZoneInfo(name)
+
+
+@lru_cache(maxsize=256)
+def _professional_pattern(names: tuple[str, ...]) -> re.Pattern | None:
+    """
+    Regex compilada con los nombres de los profesionales de un negocio: una sola
+    pasada por las notas de la cita. Los nombres más largos primero ("Ana María" antes que "Ana").
+    """
+    if not names:
+        return None
+    return re.compile('|'.join(re.escape(name) for name in sorted(names, key=len, reverse=True)))
+
+
+class _ClientEmailContext:
+    """Datos de un negocio que se repiten en todas sus citas (parseados una vez por cliente)."""
+    
+    __slots__ = ("business_name", "business_type", "tz", "professional_re")
+    
+    def __init__(self, business_name: str, tools_config: dict | None):
+        tools_config = tools_config or {}
+        self.business_name = business_name
+        self.business_type = tools_config.get("business_type", "salon")
+        self.tz = _tz(tools_config.get('timezone', 'America/Santo_Domingo'))
+        self.professional_re = _professional_pattern(tuple(
+            prof["name"] for prof in tools_config.get("professionals", []) if prof.get("name")
+        ))
+
+
+async def _send_appointment_email(
+    row: Row,
+    ctx: _ClientEmailContext,
+    hours_before: int,
+    kind: str,
+    sem: asyncio.Semaphore,
+) -> tuple[bool, str | None]:
+    """
+    Envía el correo de una cita (recordatorio o confirmación).
+    
+    Returns:
+        (enviado, mensaje de error o None)
+    """
+    try:
+        # La consulta ya filtra clientes sin email (_CUSTOMER_EMAIL)
+        customer_email = row.email
+        local_time = row.start_time.astimezone(ctx.tz)
+        
+        notes = row.notes or ""
+        match = ctx.professional_re.search(notes) if ctx.professional_re else None
+        appointment_details = {
+            "servicio": notes.partition('\n')[0] or "Cita",
+            "profesional": match.group(0) if match else None,
+        }
+        
+        async with sem:
+            ok = await email_service.send_reminder_email(
+                to_email=customer_email,
+                business_name=ctx.business_name,
+                business_type=ctx.business_type,
+                customer_name=row.full_name or "Cliente",
+                appointment_date=local_time,
+                appointment_details=appointment_details,
+                hours_before=hours_before,
+            )
+        if ok:
+            logger.debug(f"Correo de {kind} enviado a {customer_email}")
+        return bool(ok), None
+        
+    except Exception as e:
+        error_msg = f"Error enviando {kind} a {row.phone_number}: {str(e)}"
+        logger.error(error_msg, exc_info=True)
+        return False, error_msg
+
+
+async def _send_appointment_emails(
+    rows: list[Row], hours_before: int, kind: str
+) -> tuple[int, list[str]]:
+    """
+    Envía los correos de todas las citas en paralelo (acotado) y cuenta enviados/errores.
+    rows (_REMINDER_COLUMNS) viene ordenado por cliente:
+    zona horaria y profesionales se evalúan una vez por cliente.
+    """
+    sem = asyncio.Semaphore(_EMAIL_CONCURRENCY)
+    sends = []
+    config_errors = []
+    for client_id, group in groupby(rows, key=lambda row: row.client_id):
+        group = list(group)
+        try:
+            ctx = _ClientEmailContext(group[0].business_name, group[0].tools_config)
+        except Exception as e:
+            # Config mal formada de un negocio: se omiten sus citas, no las de los demás
+            error_msg = f"Config inválida del cliente {client_id} ({len(group)} {kind}(s) sin enviar): {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            config_errors.append(error_msg)
+            continue
+        sends.extend(
+            _send_appointment_email(row, ctx, hours_before, kind, sem)
+            for row in group
+        )
+    results = await asyncio.gather(*sends)
+    sent_count = sum(1 for ok, _ in results if ok)
+    errors = config_errors + [error for _, error in results if error]
+    return sent_count, errors
+
+
+async def _email_appointments_in_window(
+    window_start: datetime, window_end: datetime, hours_before: int, kind: str
+) -> tuple[int, list[str]]:
+    """
+    Busca las citas confirmadas en [window_start, window_end) y les envía el correo,
+    por lotes de _APPOINTMENTS_BATCH_SIZE leídos en streaming.
+    """
+    sent_count, errors = 0, []
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(
+            select(*_REMINDER_COLUMNS)
+            .join(Customer, Appointment.customer_id == Customer.id)
+            .join(Client, Appointment.client_id == Client.id)
+            .where(
+                and_(
+                    Appointment.start_time >= window_start,
+                    Appointment.start_time < window_end,
+                    Appointment.status == "CONFIRMED",
+                    Client.is_active == True,
+                    _CUSTOMER_EMAIL.isnot(None),
+                    _CUSTOMER_EMAIL != "",
+                )
+            )
+            .order_by(Client.id, Appointment.start_time)
+            .execution_options(yield_per=_APPOINTMENTS_BATCH_SIZE)
+        )
+        
+        async for batch in result.partitions():
+            batch_sent, batch_errors = await _send_appointment_emails(batch, hours_before, kind)
+            sent_count += batch_sent
+            errors.extend(batch_errors)
+    return sent_count, errors
+
 
 async def send_appointment_reminders_task(hours_before: int = 24) -> dict:
     """
@@ -26,70 +193,13 @@ async def send_appointment_reminders_task(hours_before: int = 24) -> dict:
         dict con status, reminders_sent, errors, window
     """
     try:
-        now = datetime.now(pytz.UTC)
+        now = datetime.now(timezone.utc)
         reminder_window_start = now + timedelta(hours=hours_before - 1)
         reminder_window_end = now + timedelta(hours=hours_before + 1)
         
-        sent_count = 0
-        errors = []
-        
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(
-                select(Appointment, Customer, Client)
-                .join(Customer, Appointment.customer_id == Customer.id)
-                .join(Client, Appointment.client_id == Client.id)
-                .where(
-                    and_(
-                        Appointment.start_time >= reminder_window_start,
-                        Appointment.start_time <= reminder_window_end,
-                        Appointment.status == "CONFIRMED",
-                        Client.is_active == True
-                    )
-                )
-            )
-            
-            appointments = result.all()
-            
-            for appointment, customer, client in appointments:
-                try:
-                    customer_email = (customer.data or {}).get("email") if customer.data else None
-                    if not customer_email:
-                        logger.debug(f"Sin email para recordatorio: {customer.phone_number}, se omite")
-                        continue
-                    
-                    tz = pytz.timezone(client.tools_config.get('timezone', 'America/Santo_Domingo'))
-                    local_time = appointment.start_time.astimezone(tz)
-                    
-                    notes_parts = (appointment.notes or "").split('\n')
-                    servicio = notes_parts[0] if notes_parts else "Cita"
-                    profesional_nombre = None
-                    for prof in client.tools_config.get("professionals", []):
-                        if prof.get("name") in (appointment.notes or ""):
-                            profesional_nombre = prof.get("name")
-                            break
-                    
-                    appointment_details = {
-                        "servicio": servicio,
-                        "profesional": profesional_nombre,
-                    }
-                    
-                    ok = await email_service.send_reminder_email(
-                        to_email=customer_email,
-                        business_name=client.business_name,
-                        business_type=client.tools_config.get("business_type", "salon"),
-                        customer_name=customer.full_name or "Cliente",
-                        appointment_date=local_time,
-                        appointment_details=appointment_details,
-                        hours_before=hours_before,
-                    )
-                    if ok:
-                        sent_count += 1
-                        logger.debug(f"Recordatorio por email enviado a {customer_email}")
-                    
-                except Exception as e:
-                    error_msg = f"Error enviando recordatorio a {customer.phone_number}: {str(e)}"
-                    errors.append(error_msg)
-                    logger.error(error_msg, exc_info=True)
+        sent_count, errors = await _email_appointments_in_window(
+            reminder_window_start, reminder_window_end, hours_before, "recordatorio"
+        )
         
         return {
             "status": "completed",
@@ -123,68 +233,13 @@ async def send_confirmation_requests_task(hours_before: int = 48) -> dict:
         dict con status y confirmations_sent
     """
     try:
-        now = datetime.now(pytz.UTC)
+        now = datetime.now(timezone.utc)
         window_start = now + timedelta(hours=hours_before - 2)
         window_end = now + timedelta(hours=hours_before + 2)
         
-        sent_count = 0
-        errors = []
-        
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(
-                select(Appointment, Customer, Client)
-                .join(Customer, Appointment.customer_id == Customer.id)
-                .join(Client, Appointment.client_id == Client.id)
-                .where(
-                    and_(
-                        Appointment.start_time >= window_start,
-                        Appointment.start_time <= window_end,
-                        Appointment.status == "CONFIRMED",
-                        Client.is_active == True
-                    )
-                )
-            )
-            
-            for appointment, customer, client in result.all():
-                try:
-                    customer_email = (customer.data or {}).get("email") if customer.data else None
-                    if not customer_email:
-                        logger.debug(f"Sin email para confirmación: {customer.phone_number}, se omite")
-                        continue
-                    
-                    tz = pytz.timezone(client.tools_config.get('timezone', 'America/Santo_Domingo'))
-                    local_time = appointment.start_time.astimezone(tz)
-                    
-                    notes_parts = (appointment.notes or "").split('\n')
-                    servicio = notes_parts[0] if notes_parts else "Cita"
-                    profesional_nombre = None
-                    for prof in client.tools_config.get("professionals", []):
-                        if prof.get("name") in (appointment.notes or ""):
-                            profesional_nombre = prof.get("name")
-                            break
-                    
-                    appointment_details = {
-                        "servicio": servicio,
-                        "profesional": profesional_nombre,
-                    }
-                    
-                    ok = await email_service.send_reminder_email(
-                        to_email=customer_email,
-                        business_name=client.business_name,
-                        business_type=client.tools_config.get("business_type", "salon"),
-                        customer_name=customer.full_name or "Cliente",
-                        appointment_date=local_time,
-                        appointment_details=appointment_details,
-                        hours_before=hours_before,
-                    )
-                    if ok:
-                        sent_count += 1
-                        logger.debug(f"Confirmación por email enviada a {customer_email}")
-                    
-                except Exception as e:
-                    error_msg = f"Error enviando confirmación a {customer.phone_number}: {str(e)}"
-                    errors.append(error_msg)
-                    logger.error(error_msg, exc_info=True)
+        sent_count, errors = await _email_appointments_in_window(
+            window_start, window_end, hours_before, "confirmación"
+        )
         
         return {
             "status": "completed",
@@ -1,8 +1,80 @@
+import asyncio
 import httpx
 import logging
+import orjson
+from collections.abc import Awaitable, Callable, Mapping
+from functools import lru_cache
+from types import MappingProxyType
+
+from app.core.redis import add_unsaved_sent_message_id, save_sent_message_ids
 
 logger = logging.getLogger(__name__)
 
+# message_id enviados se acumulan hasta 50 ms o 100 ids y se guardan en un solo pipeline
+_SENT_IDS_FLUSH_DELAY = 0.05
+_SENT_IDS_MAX_BATCH = 100
+_sent_ids: list[tuple[int, str, str]] = []
+_sent_ids_flush_task: asyncio.Task | None = None
+
+# Guardados de message_id en curso (referencia fuerte: el event loop solo guarda referencias débiles)
+_pending_tasks: set[asyncio.Task] = set()
+
+
+@lru_cache(maxsize=256)
+def _auth_headers(access_token: str) -> Mapping[str, str]:
+    """Headers de autorización por token (inmutables y cacheados: pocos tenants, muchas llamadas)."""
+    return MappingProxyType({
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    })
+
+
+def _spawn(coro) -> asyncio.Task:
+    """Lanza una tarea en segundo plano conservando una referencia hasta que termine."""
+    task = asyncio.create_task(coro)
+    _pending_tasks.add(task)
+    task.add_done_callback(_pending_tasks.discard)
+    return task
+
+
+def _queue_sent_id(client_id: int, to: str, message_id: str):
+    """Encola un message_id enviado (para detectar mensajes desde Business Suite)."""
+    global _sent_ids_flush_task
+    # Visible para is_message_sent_by_bot desde ya, antes de llegar a Redis
+    add_unsaved_sent_message_id(message_id)
+    _sent_ids.append((client_id, to, message_id))
+    if len(_sent_ids) >= _SENT_IDS_MAX_BATCH:
+        _spawn(_flush_sent_ids())
+    elif _sent_ids_flush_task is None:
+        _sent_ids_flush_task = _spawn(_flush_sent_ids(_SENT_IDS_FLUSH_DELAY))
+
+
+async def _flush_sent_ids(delay: float = 0.0):
+    """Guarda en Redis los message_id encolados (tras esperar delay segundos)."""
+    global _sent_ids_flush_task
+    if delay:
+        await asyncio.sleep(delay)
+        _sent_ids_flush_task = None
+    if not _sent_ids:
+        return
+    batch = _sent_ids.copy()
+    _sent_ids.clear()
+    try:
+        await save_sent_message_ids(batch)
+    except Exception as e:
+        # Sin estos ids, el eco de Meta se tomaría como mensaje de Business Suite (IA pausada)
+        logger.warning(f"No se pudieron guardar {len(batch)} message_id enviados: {e}")
+
+
+async def flush_sent_ids():
+    """
+    Espera los guardados en curso y guarda los message_id que queden encolados.
+    Llamar al cerrar la aplicación, antes de cerrar Redis.
+    """
+    if _pending_tasks:
+        await asyncio.gather(*_pending_tasks, return_exceptions=True)
+    await _flush_sent_ids()
+
 
 class WhatsAppService:
     """
@@ -11,8 +83,10 @@ class WhatsAppService:
     """
     
     def __init__(self):
-        # Cliente compartido con connection pooling (sin headers por defecto)
+        # Cliente compartido con connection pooling (sin headers por defecto).
+        # HTTP/2: muchas peticiones concurrentes a graph.facebook.com sobre una sola conexión TLS
         self._client = httpx.AsyncClient(
+            http2=True,
             timeout=30.0,
             limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
         )
@@ -21,12 +95,17 @@ class WhatsAppService:
         """Cierra el cliente HTTP. Llamar al cerrar la aplicación."""
         await self._client.aclose()
     
-    def _headers(self, access_token: str) -> dict:
-        """Construye headers de autorización para un cliente específico."""
-        return {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """
+        Cliente HTTP compartido (pool keep-alive) para otras descargas salientes
+        del proceso (ej. catálogo PDF), en lugar de abrir un cliente por llamada.
+        """
+        return self._client
+    
+    def _headers(self, access_token: str) -> Mapping[str, str]:
+        """Headers de autorización para un cliente específico."""
+        return _auth_headers(access_token)
     
     def _base_url(self, phone_number_id: str, api_version: str) -> str:
         """Construye la URL base de la API para un cliente específico."""
@@ -58,21 +137,16 @@ class WhatsAppService:
         
         try:
             response = await self._client.post(
-                url, json=payload, headers=self._headers(access_token)
+                url, content=orjson.dumps(payload), headers=self._headers(access_token)
             )
             response.raise_for_status()
-            result = response.json()
+            result = orjson.loads(response.content)
             
-            # Guardar message_id en Redis (para detectar mensajes desde Business Suite)
+            # Guardar message_id en Redis en segundo plano y por lotes (no suma un round-trip al envío)
             if client_id and "messages" in result:
                 message_id = result["messages"][0].get("id")
                 if message_id:
-                    try:
-                        from app.core.redis import ConversationMemory
-                        memory = ConversationMemory(client_id, to)
-                        await memory.save_sent_message_id(message_id)
-                    except Exception as e:
-                        logger.debug(f"No se pudo guardar message_id: {e}")
+                    _queue_sent_id(client_id, to, message_id)
             
             logger.debug(f"Mensaje enviado a {to}")
             return result
@@ -109,26 +183,59 @@ class WhatsAppService:
         
         try:
             response = await self._client.post(
-                url, json=payload, headers=self._headers(access_token)
+                url, content=orjson.dumps(payload), headers=self._headers(access_token)
             )
             response.raise_for_status()
-            return response.json()
+            return orjson.loads(response.content)
         except Exception as e:
             logger.warning(f"No se pudo marcar como leído: {e}")
             return {}
     
+    async def acknowledge(
+        self,
+        message_id: str,
+        *,
+        typing: bool = False,
+        access_token: str,
+        phone_number_id: str,
+        api_version: str
+    ) -> None:
+        """
+        Marca un mensaje como leído y, con typing=True, muestra 'escribiendo...'
+        en la misma llamada (el payload del typing indicator ya incluye status=read).
+        Si el typing indicator falla, se reintenta solo la marca de leído.
+        """
+        if typing and await self.send_typing_indicator(
+            message_id=message_id,
+            access_token=access_token,
+            phone_number_id=phone_number_id,
+            api_version=api_version,
+        ):
+            return
+        
+        await self.mark_as_read(
+            message_id,
+            access_token=access_token,
+            phone_number_id=phone_number_id,
+            api_version=api_version,
+        )
+    
     async def send_typing_indicator(
         self,
-        to: str,
+        to: str | None = None,
         *,
         message_id: str,
         access_token: str,
         phone_number_id: str,
         api_version: str
-    ) -> None:
+    ) -> bool:
         """
-        Envía el indicador nativo de 'escribiendo...' en WhatsApp.
-        Se auto-cancela después de 25 segundos o al enviar un mensaje.
+        Envía el indicador nativo de 'escribiendo...' en WhatsApp (también marca
+        el mensaje como leído). Se auto-cancela después de 25 segundos o al enviar un mensaje.
+        Meta lo asocia a message_id; to no se usa en el payload.
+        
+        Returns:
+            True si Meta lo aceptó
         """
         url = f"{self._base_url(phone_number_id, api_version)}/messages"
         
@@ -143,12 +250,14 @@ class WhatsAppService:
         
         try:
             response = await self._client.post(
-                url, json=payload, headers=self._headers(access_token)
+                url, content=orjson.dumps(payload), headers=self._headers(access_token)
             )
-            if response.status_code >= 400:
-                logger.debug(f"Typing indicator falló: {response.status_code} - {response.text}")
+            if response.status_code < 400:
+                return True
+            logger.debug(f"Typing indicator falló: {response.status_code} - {response.text}")
         except Exception as e:
             logger.debug(f"No se pudo enviar typing indicator: {e}")
+        return False
     
     async def get_media_url(
         self,
@@ -174,7 +283,7 @@ class WhatsAppService:
                 url, headers=self._headers(access_token)
             )
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             return data.get("url")
         except Exception as e:
             logger.error(f"Error obteniendo URL de media: {e}")
@@ -187,23 +296,55 @@ class WhatsAppService:
         access_token: str
     ) -> bytes | None:
         """
-        Descarga un archivo multimedia.
+        Descarga un archivo multimedia completo en memoria.
+        
+        Args:
+            media_url: URL obtenida de get_media_url
+            access_token: Token de acceso de Meta del cliente
+            
+        Returns:
+            Contenido binario del archivo, o None si falla
+        """
+        buffer = bytearray()
+        
+        async def collect(chunk: bytes):
+            buffer.extend(chunk)
+        
+        size = await self.stream_media(media_url, access_token=access_token, sink=collect)
+        return bytes(buffer) if size is not None else None
+    
+    async def stream_media(
+        self,
+        media_url: str,
+        *,
+        access_token: str,
+        sink: Callable[[bytes], Awaitable[None]]
+    ) -> int | None:
+        """
+        Descarga un archivo multimedia en streaming: sink recibe cada bloque a medida
+        que llega (ej. escribir a disco/S3) en lugar de acumular el archivo en memoria.
         
         Args:
             media_url: URL obtenida de get_media_url
             access_token: Token de acceso de Meta del cliente
+            sink: Recibe cada bloque descargado
             
         Returns:
-            Contenido binario del archivo
+            Cantidad de bytes entregados a sink, o None si falla
         """
         try:
-            response = await self._client.get(
-                media_url, 
+            async with self._client.stream(
+                "GET",
+                media_url,
                 headers=self._headers(access_token),
                 timeout=60.0
-            )
-            response.raise_for_status()
-            return response.content
+            ) as response:
+                response.raise_for_status()
+                size = 0
+                async for chunk in response.aiter_bytes(65536):
+                    await sink(chunk)
+                    size += len(chunk)
+                return size
         except Exception as e:
             logger.error(f"Error descargando media: {e}")
             return None